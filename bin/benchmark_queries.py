@@ -0,0 +1,63 @@
+"""
+Query Overhead Benchmark
+
+Times the per-query Python overhead of the legacy Query API against the
+select() statements the models use, on an in-memory SQLite database so
+that the database itself costs next to nothing.
+
+Usage: python bin/benchmark_queries.py [iterations]
+"""
+import os
+import sys
+import timeit
+import warnings
+
+os.environ.setdefault("DATABASE_URI", "sqlite://")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# pylint: disable=wrong-import-position
+from sqlalchemy import select  # noqa: E402
+from service.models import Account, db  # noqa: E402
+from service.common.statement_stats import statement_stats  # noqa: E402
+
+
+def legacy_get():
+    """Primary key lookup through Query.get()"""
+    db.session.expunge_all()
+    return Account.query.get(1)
+
+
+def session_get():
+    """Primary key lookup through Session.get()"""
+    db.session.expunge_all()
+    return db.session.get(Account, 1)
+
+
+def legacy_filter():
+    """Filtered read through Query.filter()"""
+    return Account.query.filter(Account.name == "Account 1").all()
+
+
+def select_filter():
+    """Filtered read through select()"""
+    return db.session.scalars(select(Account).where(Account.name == "Account 1")).all()
+
+
+def main(iterations):
+    """Runs every pair of benchmarks and prints microseconds per call"""
+    warnings.simplefilter("ignore")  # the legacy API is deprecated, which is the point
+    for number in range(100):
+        db.session.add(Account(name=f"Account {number}", email=f"a{number}@example.com", address="1 Main Street"))
+    db.session.commit()
+    pairs = (("get by id", legacy_get, session_get), ("filter by name", legacy_filter, select_filter))
+    for name, before, after in pairs:
+        results = []
+        for func in (before, after):
+            func()  # warm the compiled cache
+            results.append(min(timeit.repeat(func, number=iterations, repeat=5)) / iterations * 1e6)
+        print(f"{name:<16} legacy {results[0]:8.1f} us  select {results[1]:8.1f} us  ({results[1] / results[0]:.2f}x)")
+    print("statement cache:", statement_stats.stats())
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
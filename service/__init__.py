@@ -17,15 +17,15 @@ talisman = Talisman(app)
 cors = CORS(app)
 app.config.from_object(config)
 
+# Set up logging for production before anything else registers request hooks
+log_handlers.init_logging(app, "gunicorn.error")
+
 # Import the routes After the Flask app is created
 # pylint: disable=wrong-import-position, cyclic-import, wrong-import-order
 from service import routes, models  # noqa: F401 E402
 
 # pylint: disable=wrong-import-position
-from service.common import error_handlers, cli_commands  # noqa: F401 E402
-
-# Set up logging for production
-log_handlers.init_logging(app, "gunicorn.error")
+from service.common import error_handlers, cli_commands, jobs, lifecycle, rate_limit  # noqa: F401 E402
 
 app.logger.info(70 * "*")
 app.logger.info("  A C C O U N T   S E R V I C E   R U N N I N G  ".center(70, "*"))
@@ -33,9 +33,13 @@ app.logger.info(70 * "*")
 
 try:
     models.init_db(app)  # make our database tables
+    jobs.runner.fail_stale()  # left behind by workers that stopped
 except Exception as error:  # pylint: disable=broad-except
     app.logger.critical("%s: Cannot continue", error)
     # gunicorn requires exit code 4 to stop spawning workers when they die
     sys.exit(4)
 
+# Ready for traffic once warm, drains on SIGTERM
+lifecycle.start()
+
 app.logger.info("Service initialized!")
@@ -0,0 +1,68 @@
+"""
+Bloom Filter
+
+This module answers "was this key ever added?" in a few bytes per key.
+A miss is certain, a hit may be a false positive at about the error rate
+the filter was sized for, so a hit must be confirmed elsewhere. Keys
+cannot be removed, a removed key keeps answering as a possible hit.
+"""
+import hashlib
+import math
+import threading
+
+
+class BloomFilter:
+    """Fixed size Bloom filter over string keys
+
+    Args:
+        capacity (int): keys the filter holds before it exceeds its error rate
+        error_rate (float): false positive rate at capacity
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.size = max(8, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def __len__(self):
+        return self.count
+
+    def add(self, key):
+        """Adds a key"""
+        positions = self._positions(key)
+        with self._lock:
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def full(self) -> bool:
+        """Returns True once more keys were added than the filter was sized for"""
+        return self.count > self.capacity
+
+    def false_positive_rate(self) -> float:
+        """Returns the expected false positive rate at the current number of keys"""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+    def stats(self) -> dict:
+        """Returns the size of the filter and its expected false positive rate"""
+        return {
+            "capacity": self.capacity,
+            "keys": self.count,
+            "bytes": len(self._bits),
+            "hashes": self.hashes,
+            "false_positive_rate": round(self.false_positive_rate(), 6),
+        }
+
+    def _positions(self, key):
+        """Derives the bit positions of a key from one digest by double hashing"""
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + number * second) % self.size for number in range(self.hashes)]
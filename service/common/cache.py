@@ -0,0 +1,137 @@
+"""
+Response Cache
+
+This module contains a size-bounded LRU cache of encoded responses.
+Entries are tagged with the table generation they were built from so
+that any write to the table invalidates them without having to track
+which pages a write affected.
+"""
+import gzip
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheEntry:
+    """A pre-serialized response body and the headers to send with it"""
+
+    __slots__ = ("generation", "body", "headers", "created", "gzipped")
+
+    def __init__(self, generation: int, body: bytes, headers: dict):
+        self.generation = generation
+        self.body = body
+        self.headers = headers
+        self.created = time.monotonic()
+        self.gzipped = None
+
+    @property
+    def size(self) -> int:
+        """Number of bytes held by this entry"""
+        return len(self.body) + len(self.gzipped or b"")
+
+
+class ResponseCache:
+    """LRU cache of encoded responses bounded by entry count and bytes
+
+    Args:
+        max_entries (int): maximum number of cached responses
+        max_bytes (int): maximum number of body bytes held by the cache
+        ttl (float): seconds an entry stays valid, 0 to disable. This bounds
+            how stale a page can get when another worker writes to the table
+        gzip_min_bytes (int): smallest body that is worth compressing
+    """
+
+    def __init__(self, max_entries=256, max_bytes=16 * 1024 * 1024, ttl=0.0, gzip_min_bytes=1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.gzip_min_bytes = gzip_min_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, generation: int):
+        """Returns the entry for key if it was built from this generation"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_fresh(entry, generation):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, generation: int, body: bytes, headers=None) -> CacheEntry:
+        """Stores an encoded body and returns its entry"""
+        entry = CacheEntry(generation, body, headers or {})
+        if entry.size > self.max_bytes or self.max_entries <= 0:
+            return entry  # too big to ever fit, serve it uncached
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            self._evict()
+        return entry
+
+    def gzipped(self, key, entry: CacheEntry):
+        """Returns the gzip encoding of an entry, compressing it at most once
+
+        Returns None when the body is too small to be worth compressing
+        """
+        if len(entry.body) < self.gzip_min_bytes:
+            return None
+        if entry.gzipped is None:
+            compressed = gzip.compress(entry.body, compresslevel=6)
+            with self._lock:
+                if entry.gzipped is None:
+                    entry.gzipped = compressed
+                    if self._entries.get(key) is entry:
+                        self._bytes += len(compressed)
+                        self._evict()
+        return entry.gzipped
+
+    def clear(self):
+        """Drops every cached entry"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        """Returns the hit, miss and eviction counters of the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    ######################################################################
+    #  P R I V A T E   M E T H O D S   (caller holds the lock)
+    ######################################################################
+
+    def _is_fresh(self, entry, generation):
+        if entry.generation != generation:
+            return False
+        return not self.ttl or time.monotonic() - entry.created < self.ttl
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def _evict(self):
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+        ):
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self.evictions += 1
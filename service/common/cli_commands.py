@@ -1,8 +1,11 @@
 """
 Flask CLI Command Extensions
 """
+from datetime import datetime, timedelta
+import click
 from service import app
-from service.models import db
+from service.models import Account, ChangeLog, IdBlock, Job, JobResult, db
+from service.common.sharding import router
 
 
 ######################################################################
@@ -13,9 +16,65 @@ from service.models import db
 @app.cli.command("db-create")
 def db_create():
     """
-    Recreates a local database. You probably should not use this on
-    production. ;-)
+    Recreates a local database, and every shard when accounts are
+    sharded. You probably should not use this on production. ;-)
     """
-    db.drop_all()
-    db.create_all()
-    db.session.commit()
+    for shard in router.shards:
+        with router.on(shard):
+            db.Model.metadata.drop_all(db.session.get_bind())
+            db.Model.metadata.create_all(db.session.get_bind())
+            db.session.commit()
+    if router.sharded:
+        home_tables = [Job.__table__, JobResult.__table__, IdBlock.__table__]
+        db.Model.metadata.drop_all(db.engine, tables=home_tables)
+        db.Model.metadata.create_all(db.engine, tables=home_tables)
+        IdBlock.ensure(Account.__tablename__, 1)
+
+
+######################################################################
+# Command to move cold accounts to the archive table
+# Usage:
+#   flask db-archive --before 2015-01-01
+######################################################################
+@app.cli.command("db-archive")
+@click.option("--before", required=True, type=click.DateTime(formats=["%Y-%m-%d"]),
+              help="Archive the accounts that joined before this date")
+@click.option("--batch-size", default=None, type=int, help="Accounts moved per transaction")
+def db_archive(before, batch_size):
+    """
+    Moves accounts that joined before a date to account_archive. Whole
+    yearly partitions are moved at once, other rows in short batches.
+    """
+    count = Account.archive(before.date(), batch_size or app.config["ARCHIVE_BATCH_SIZE"])
+    click.echo(f"Archived {count} accounts")
+
+
+######################################################################
+# Command to drop old entries of the change feed
+# Usage:
+#   flask changes-prune --days 30
+######################################################################
+@app.cli.command("changes-prune")
+@click.option("--days", default=30, show_default=True, help="Keep the changes of this many days")
+def changes_prune(days):
+    """
+    Deletes change feed entries older than the retention period. Consumers
+    holding an older token get 410_GONE and must resync.
+    """
+    count = ChangeLog.prune(datetime.utcnow() - timedelta(days=days))
+    click.echo(f"Pruned {count} changes")
+
+
+######################################################################
+# Command to recount the signups per day behind GET /accounts/stats
+# Usage:
+#   flask rollup-rebuild
+######################################################################
+@app.cli.command("rollup-rebuild")
+def rollup_rebuild():
+    """
+    Recounts the daily signup rollup from the accounts and the archive,
+    for when it drifted through writes that bypassed the models
+    """
+    count = Account.rebuild_rollup()
+    click.echo(f"Counted {count} signups")
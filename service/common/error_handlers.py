@@ -2,7 +2,7 @@
 Module: error_handlers
 """
 from flask import jsonify
-from service.models import DataValidationError
+from service.models import DataValidationError, DuplicateEmailError
 from service import app
 from . import status
 
@@ -16,6 +16,12 @@ def request_validation_error(error):
     return bad_request(error)
 
 
+@app.errorhandler(DuplicateEmailError)
+def duplicate_email_error(error):
+    """Handles emails that already belong to another Account"""
+    return conflict(error)
+
+
 @app.errorhandler(status.HTTP_400_BAD_REQUEST)
 def bad_request(error):
     """Handles bad requests with 400_BAD_REQUEST"""
@@ -29,6 +35,18 @@ def bad_request(error):
     )
 
 
+@app.errorhandler(status.HTTP_401_UNAUTHORIZED)
+def unauthorized(error):
+    """Handles requests without valid credentials with 401_UNAUTHORIZED"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_401_UNAUTHORIZED, error="Unauthorized", message=message),
+        status.HTTP_401_UNAUTHORIZED,
+        {"WWW-Authenticate": "Bearer"},
+    )
+
+
 @app.errorhandler(status.HTTP_404_NOT_FOUND)
 def not_found(error):
     """Handles resources not found with 404_NOT_FOUND"""
@@ -55,6 +73,28 @@ def method_not_supported(error):
     )
 
 
+@app.errorhandler(status.HTTP_409_CONFLICT)
+def conflict(error):
+    """Handles requests that conflict with the state of a resource with 409_CONFLICT"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_409_CONFLICT, error="Conflict", message=message),
+        status.HTTP_409_CONFLICT,
+    )
+
+
+@app.errorhandler(status.HTTP_410_GONE)
+def gone(error):
+    """Handles resources that are no longer available with 410_GONE"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_410_GONE, error="Gone", message=message),
+        status.HTTP_410_GONE,
+    )
+
+
 @app.errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 def mediatype_not_supported(error):
     """Handles unsupported media requests with 415_UNSUPPORTED_MEDIA_TYPE"""
@@ -70,6 +110,22 @@ def mediatype_not_supported(error):
     )
 
 
+@app.errorhandler(status.HTTP_429_TOO_MANY_REQUESTS)
+def too_many_requests(error):
+    """Handles rate limited requests with 429_TOO_MANY_REQUESTS"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_429_TOO_MANY_REQUESTS,
+            error="Too Many Requests",
+            message=message,
+        ),
+        status.HTTP_429_TOO_MANY_REQUESTS,
+        retry_after_header(error),
+    )
+
+
 @app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 def internal_server_error(error):
     """Handles unexpected server error with 500_SERVER_ERROR"""
@@ -83,3 +139,40 @@ def internal_server_error(error):
         ),
         status.HTTP_500_INTERNAL_SERVER_ERROR,
     )
+
+
+@app.errorhandler(status.HTTP_501_NOT_IMPLEMENTED)
+def not_implemented(error):
+    """Handles features unavailable in this configuration with 501_NOT_IMPLEMENTED"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_501_NOT_IMPLEMENTED,
+            error="Not Implemented",
+            message=message,
+        ),
+        status.HTTP_501_NOT_IMPLEMENTED,
+    )
+
+
+@app.errorhandler(status.HTTP_503_SERVICE_UNAVAILABLE)
+def service_unavailable(error):
+    """Handles shed requests with 503_SERVICE_UNAVAILABLE"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            error="Service Unavailable",
+            message=message,
+        ),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        retry_after_header(error),
+    )
+
+
+def retry_after_header(error):
+    """Passes the Retry-After hint of an HTTPException on to the client"""
+    retry_after = getattr(error, "retry_after", None)
+    return {"Retry-After": str(retry_after)} if retry_after else {}
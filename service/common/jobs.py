@@ -0,0 +1,321 @@
+"""
+Background Jobs
+
+This module runs long operations such as exports, imports and bulk
+changes on a pool of worker threads instead of the request that submits
+them. The state of every job is kept in the job table, so any worker
+process can report its progress.
+
+A job runs in the process that accepted it, which sends a heartbeat for
+it until it finishes. If that process exits, the heartbeat stops and the
+job is failed at the next startup or submission, so it has to be
+submitted again. Results are stored in the database, next to the job.
+"""
+import heapq
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import select, update
+from service import app
+from service.models import Account, DataValidationError, Job, JobResult, db
+from . import metrics
+from .sharding import router
+
+logger = logging.getLogger("flask.app")
+
+
+class JobCancelled(Exception):
+    """Stops a job whose cancellation was requested"""
+
+
+class JobContext:
+    """Handed to a running job to report progress and notice cancellation"""
+
+    def __init__(self, job):
+        self.job = job
+        self.chunks = 0
+
+    def write(self, data):
+        """Appends a chunk to the result of the job"""
+        with router.on(None):
+            JobResult.append(self.job.id, self.chunks, data)
+            self.chunks += 1
+
+    def progress(self, done, total=None):
+        """Records the work done so far, raises JobCancelled if the job was cancelled"""
+        with router.on(None):  # jobs live in DATABASE_URI, not on the shard being worked on
+            self.job.progress = done
+            if total is not None:
+                self.job.total = total
+            db.session.commit()
+            if Job.is_cancel_requested(self.job.id):
+                raise JobCancelled()
+
+
+class JobRunner:
+    """Runs registered job kinds on a thread pool
+
+    Args:
+        flask_app: the Flask app the jobs run in
+        max_workers (int): worker threads, 0 to run every job inside the
+            request that submits it
+        max_unfinished (int): most jobs queued or running at once
+        heartbeat_seconds (float): how often the jobs of this process are
+            marked alive
+        stale_seconds (float): how long a job may go without a heartbeat
+            before it is failed as abandoned
+    """
+
+    def __init__(self, flask_app, max_workers=2, max_unfinished=20, heartbeat_seconds=10.0, stale_seconds=60.0):
+        self.app = flask_app
+        self.max_workers = max_workers
+        self.max_unfinished = max_unfinished
+        self.heartbeat_seconds = heartbeat_seconds
+        self.stale_seconds = stale_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.handlers = {}
+        self.counts = dict.fromkeys(("submitted",) + Job.FINISHED, 0)
+        self._executor = None
+        self._heartbeat = None
+        self._lock = threading.Lock()
+
+    def handler(self, kind, validate=None):
+        """Registers the function that runs a kind of job
+
+        The function receives a JobContext and the job parameters and
+        returns the JSON result of the job. validate receives the
+        parameters at submission and raises DataValidationError.
+        """
+
+        def register(func):
+            self.handlers[kind] = (func, validate)
+            return func
+
+        return register
+
+    def has_capacity(self):
+        """Returns True if another job may be submitted, abandoned jobs do not count"""
+        self.fail_stale()
+        return Job.unfinished() < self.max_unfinished
+
+    def fail_stale(self):
+        """Fails the jobs left queued or running by processes that stopped"""
+        failed = Job.fail_stale(datetime.utcnow() - timedelta(seconds=self.stale_seconds))
+        if failed:
+            logger.warning("Failed %d jobs abandoned by their worker", failed)
+        return failed
+
+    def submit(self, kind, params):
+        """Queues a job and returns it"""
+        _, validate = self.handlers[kind]
+        if validate:
+            validate(params)
+        job = Job(kind=kind, params=params, owner=self.owner, heartbeat_at=datetime.utcnow())
+        db.session.add(job)
+        db.session.commit()
+        self._count("submitted")
+        self._start_heartbeat()
+        logger.info("Submitted %s job %s", kind, job.id)
+        if self.max_workers:
+            self._pool().submit(self._run_in_context, job.id)
+        else:
+            self.run(job.id)
+        return job
+
+    def cancel(self, job):
+        """Cancels a queued job at once, a running one at its next progress report"""
+        logger.info("Cancelling job %s", job.id)
+        cancelled = db.session.execute(
+            update(Job)
+            .where(Job.id == job.id, Job.status == Job.QUEUED)
+            .values(status=Job.CANCELLED, cancel_requested=True, finished_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not cancelled:
+            job.cancel_requested = True
+        db.session.commit()
+        db.session.refresh(job)
+        if cancelled:
+            self._count(Job.CANCELLED)
+
+    def run(self, job_id):
+        """Runs a queued job in the current thread and records its outcome"""
+        claimed = db.session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == Job.QUEUED)
+            .values(status=Job.RUNNING, started_at=datetime.utcnow(), heartbeat_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if not claimed:
+            return  # cancelled before it started
+        job = Job.find(job_id)
+        func, _ = self.handlers[job.kind]
+        try:
+            job.result = func(JobContext(job), job.params)
+            outcome = Job.SUCCEEDED
+        except JobCancelled:
+            outcome = Job.CANCELLED
+        except Exception as error:  # pylint: disable=broad-except
+            logger.exception("Job %s failed", job_id)
+            db.session.rollback()
+            job.error = str(error)
+            outcome = Job.FAILED
+        if outcome != Job.SUCCEEDED:
+            JobResult.discard(job_id)
+        job.status = outcome
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        self._count(outcome)
+        logger.info("Job %s %s", job_id, outcome)
+
+    def stats(self) -> dict:
+        """Returns the number of jobs submitted and finished by this process"""
+        with self._lock:
+            return dict(self.counts, max_workers=self.max_workers)
+
+    def _count(self, outcome):
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._send_heartbeats, name="job-heartbeat", daemon=True)
+                self._heartbeat.start()
+
+    def _send_heartbeats(self):
+        while True:
+            time.sleep(self.heartbeat_seconds)
+            with self.app.app_context():
+                try:
+                    Job.heartbeat(self.owner)
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Could not send the heartbeat of the jobs of %s", self.owner)
+                finally:
+                    db.session.remove()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="job")
+            return self._executor
+
+    def _run_in_context(self, job_id):
+        with self.app.app_context():
+            try:
+                self.run(job_id)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Job %s could not be run", job_id)
+            finally:
+                db.session.remove()
+
+
+runner = JobRunner(
+    app,
+    max_workers=app.config["JOB_MAX_WORKERS"],
+    max_unfinished=app.config["JOB_MAX_UNFINISHED"],
+    heartbeat_seconds=app.config["JOB_HEARTBEAT_SECONDS"],
+    stale_seconds=app.config["JOB_STALE_SECONDS"],
+)
+metrics.register("jobs", runner.stats)
+
+
+######################################################################
+#  A C C O U N T   J O B S
+######################################################################
+def shard_records(shard, batch_size):
+    """Yields the serialized Accounts of a shard in id order, one batch per query"""
+    after = 0
+    while True:
+        with router.on(shard):
+            accounts = db.session.scalars(
+                select(Account).where(Account.id > after).order_by(Account.id).limit(batch_size)
+            ).all()
+            records = [account.serialize() for account in accounts]
+        if not records:
+            return
+        yield from records
+        after = records[-1]["id"]
+
+
+@runner.handler("export")
+def export_accounts(context, _params):
+    """Stores every Account as a line of JSON in the result of the job, one chunk per batch"""
+    batch_size = app.config["BULK_BATCH_SIZE"]
+    total = Account.count("cached")[0]
+    exported = 0
+    lines = []
+    records = heapq.merge(
+        *(shard_records(shard, batch_size) for shard in router.targets()), key=lambda record: record["id"]
+    )
+    for record in records:
+        lines.append(json.dumps(record) + "\n")
+        exported += 1
+        if len(lines) == batch_size:
+            context.write("".join(lines))
+            lines = []
+            context.progress(exported, max(total, exported))
+    if lines:
+        context.write("".join(lines))
+    context.progress(exported, max(total, exported))
+    return {"exported": exported, "location": f"/jobs/{context.job.id}/result"}
+
+
+def validate_import(params):
+    """Checks every Account of an import before it is queued"""
+    records = params.get("accounts")
+    if not isinstance(records, list) or not records:
+        raise DataValidationError("Invalid import: accounts must be a list of accounts")
+    accounts = []
+    for index, data in enumerate(records):
+        try:
+            accounts.append(Account().deserialize(data))
+        except (DataValidationError, ValueError) as error:
+            raise DataValidationError(f"Invalid import: account {index}: {error}") from error
+    Account.check_emails([account.email for account in accounts])
+
+
+@runner.handler("import", validate=validate_import)
+def import_accounts(context, params):
+    """Creates the Accounts of an import, one batch per transaction"""
+    batch_size = app.config["BULK_BATCH_SIZE"]
+    records = params["accounts"]
+    created = 0
+    for start in range(0, len(records), batch_size):
+        accounts = [Account().deserialize(data) for data in records[start:start + batch_size]]
+        Account.create_many(accounts)
+        created += len(accounts)
+        context.progress(created, len(records))
+    return {"created": created}
+
+
+def validate_bulk_update(params):
+    """Checks the filter and the fields of a bulk update before it is queued"""
+    Account.bulk_filter(params.get("filter"))
+    Account.bulk_values(params.get("set"))
+
+
+@runner.handler("bulk_update", validate=validate_bulk_update)
+def bulk_update_accounts(context, params):
+    """Runs a bulk update, reporting progress after every batch"""
+    criteria = Account.bulk_filter(params["filter"])
+    context.progress(0, Account.count("exact", criteria)[0])
+    updated = Account.bulk_update(
+        criteria, Account.bulk_values(params["set"]), app.config["BULK_BATCH_SIZE"], context.progress
+    )
+    return {"affected": updated}
+
+
+@runner.handler("bulk_delete", validate=lambda params: Account.bulk_filter(params.get("filter")))
+def bulk_delete_accounts(context, params):
+    """Runs a bulk delete, reporting progress after every batch"""
+    criteria = Account.bulk_filter(params["filter"])
+    context.progress(0, Account.count("exact", criteria)[0])
+    deleted = Account.bulk_delete(criteria, app.config["BULK_BATCH_SIZE"], context.progress)
+    return {"affected": deleted}
@@ -0,0 +1,190 @@
+"""
+Worker Lifecycle
+
+This module warms a new worker up before it reports ready and drains it
+when it is told to stop.
+
+Warm-up opens the database pool connections and sends representative
+requests through the app, so statements are compiled and caches filled
+before the first real request pays for it. Until it finishes GET /ready
+answers 503 and Kubernetes keeps the pod out of the Service.
+
+On SIGTERM the worker turns unready, answers new requests with 503 so
+clients retry on another replica, waits for the requests in flight and
+only then hands the signal to the handler it replaced (gunicorn's).
+"""
+import logging
+import os
+import signal
+import threading
+import time
+from flask import abort, g, request
+from service import app
+from service.models import db
+from service.common.sharding import router
+from . import metrics, status
+
+logger = logging.getLogger("flask.app")
+
+# Probes must answer in every state
+EXEMPT_ENDPOINTS = {"health", "ready", "static"}
+
+
+class Lifecycle:
+    """Tracks whether a worker is warming up, ready or draining
+
+    Args:
+        flask_app: the Flask app of the worker
+        drain_timeout (float): most seconds to wait for requests in flight
+    """
+
+    WARMING = "warming"
+    READY = "ready"
+    DRAINING = "draining"
+
+    def __init__(self, flask_app, drain_timeout=25.0):
+        self.app = flask_app
+        self.drain_timeout = drain_timeout
+        self.state = self.WARMING
+        self.in_flight = 0
+        self.warmup_seconds = None
+        self.warmup_errors = 0
+        self.rejected = 0
+        self._idle = threading.Condition()
+
+    def ready(self) -> bool:
+        """Returns True if the worker should receive traffic"""
+        return self.state == self.READY
+
+    def warm_up(self, connections, paths):
+        """Opens pool connections and sends each path through the app, then turns ready
+
+        Failures are logged and counted but never keep the worker from
+        starting, a cold worker is better than none.
+
+        Args:
+            connections (int): connections to open per database
+            paths (list): "path" or "METHOD path" requests to send
+        """
+        started = time.monotonic()
+        for shard in [None] + [shard for shard in router.shards if shard is not None]:
+            try:
+                engine = db.get_engine(self.app, bind=shard)
+                opened = [engine.connect() for _ in range(connections)]
+                for connection in opened:
+                    connection.close()  # back to the pool, still open
+            except Exception as error:  # pylint: disable=broad-except
+                self.warmup_errors += 1
+                logger.warning("Warm-up could not open connections to %s: %s", shard or "the database", error)
+        client = self.app.test_client()
+        for path in paths:
+            method, _, url = path.strip().rpartition(" ")
+            try:
+                response = client.open(url, method=method or "GET", environ_overrides={"wsgi.url_scheme": "https"})
+                if response.status_code >= 500:
+                    raise RuntimeError(f"status {response.status_code}")
+            except Exception as error:  # pylint: disable=broad-except
+                self.warmup_errors += 1
+                logger.warning("Warm-up request %s failed: %s", path, error)
+        self.warmup_seconds = round(time.monotonic() - started, 3)
+        self.mark_ready()
+        logger.info("Warmed up in %s seconds with %d errors", self.warmup_seconds, self.warmup_errors)
+
+    def mark_ready(self):
+        """Turns ready unless already draining"""
+        with self._idle:
+            if self.state == self.WARMING:
+                self.state = self.READY
+
+    def enter(self) -> bool:
+        """Admits a request, returns False once draining"""
+        with self._idle:
+            if self.state == self.DRAINING:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def exit(self):
+        """Releases a request admitted by enter()"""
+        with self._idle:
+            self.in_flight -= 1
+            if not self.in_flight:
+                self._idle.notify_all()
+
+    def drain(self, timeout) -> bool:
+        """Stops admitting requests and waits for those in flight, False on timeout"""
+        with self._idle:
+            self.state = self.DRAINING
+            return self._idle.wait_for(lambda: not self.in_flight, timeout)
+
+    def install_signal_handler(self, signum=signal.SIGTERM):
+        """Drains on signum before passing it on to the handler it replaces"""
+        previous = signal.getsignal(signum)
+
+        def handle(received, frame):
+            # the main thread may hold the lock, drain from another thread
+            threading.Thread(
+                target=self._drain_and_exit, args=(previous, received, frame), name="drain", daemon=True
+            ).start()
+
+        signal.signal(signum, handle)
+
+    def stats(self) -> dict:
+        """Returns the state of the worker and its warm-up"""
+        return {
+            "state": self.state,
+            "in_flight": self.in_flight,
+            "rejected": self.rejected,
+            "warmup_seconds": self.warmup_seconds,
+            "warmup_errors": self.warmup_errors,
+        }
+
+    def _drain_and_exit(self, previous, signum, frame):
+        logger.info("Draining %d requests in flight", self.in_flight)
+        if not self.drain(self.drain_timeout):
+            logger.warning("Stopping with %d requests still in flight", self.in_flight)
+        if callable(previous):
+            previous(signum, frame)
+        elif previous == signal.SIG_DFL:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+
+lifecycle = Lifecycle(app, drain_timeout=app.config["DRAIN_TIMEOUT"])
+metrics.register("lifecycle", lifecycle.stats)
+
+
+def start():
+    """Warms the worker up and installs the drain handler as configured"""
+    if app.config["WARMUP_ENABLED"]:
+        paths = [path for path in app.config["WARMUP_PATHS"].split(",") if path.strip()]
+        lifecycle.warm_up(app.config["WARMUP_CONNECTIONS"], paths)
+    else:
+        lifecycle.mark_ready()
+    if app.config["DRAIN_ON_SIGTERM"] and threading.current_thread() is threading.main_thread():
+        lifecycle.install_signal_handler()
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+@app.before_request
+def admit_request():
+    """Rejects new requests with 503 while the worker drains"""
+    if request.endpoint in EXEMPT_ENDPOINTS:
+        return
+    if not lifecycle.enter():
+        abort(
+            status.HTTP_503_SERVICE_UNAVAILABLE,
+            "Service is shutting down",
+            retry_after=app.config["SHED_RETRY_AFTER"],
+        )
+    g.in_flight = True
+
+
+@app.teardown_request
+def finish_request(_error=None):
+    """Releases the request admitted by admit_request"""
+    if g.pop("in_flight", False):
+        lifecycle.exit()
@@ -4,19 +4,146 @@ Log Handlers
 This module contains utility functions to set up logging
 consistently
 """
+import atexit
+import itertools
+import json
 import logging
+import queue
+import time
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+from flask import current_app, g, has_request_context, request
+
+# Request attributes copied from a record into its JSON line
+CONTEXT_FIELDS = ("request_id", "method", "path", "status", "duration_ms")
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a single line JSON object"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps one in every N INFO (and lower) records of each log line
+
+    Each message template is counted separately so a rare line is never
+    starved by a frequent one. Warnings and errors are always kept.
+
+    Args:
+        rate (float): fraction of the records to keep
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.every = max(1, round(1 / rate)) if rate > 0 else 0
+        self._counters = {}
+
+    def filter(self, record):
+        if self.every == 1 or record.levelno > logging.INFO:
+            return True
+        if not self.every:
+            return False
+        counter = self._counters.get(record.msg)
+        if counter is None:
+            counter = self._counters.setdefault(record.msg, itertools.count())
+        return next(counter) % self.every == 0
+
+
+class ContextQueueHandler(QueueHandler):
+    """Queues records for a listener thread without formatting them
+
+    The record is only stamped with the current request id, the message
+    is formatted later by the handlers on the listener thread.
+    """
+
+    def prepare(self, record):
+        if has_request_context():
+            record.request_id = g.get("request_id")
+        return record
+
+
+def parse_sampling(value: str) -> dict:
+    """Parses 'logger=rate,...' into a dict of sampling rates"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, rate = item.rsplit("=", 1)
+        rates[name.strip()] = float(rate)
+    return rates
 
 
 def init_logging(app, logger_name: str):
     """Set up logging for production"""
     app.logger.propagate = False
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
+    handlers = list(gunicorn_logger.handlers)
     app.logger.setLevel(gunicorn_logger.level)
     # Make all log formats consistent
-    formatter = logging.Formatter(
-        "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
-    )
-    for handler in app.logger.handlers:
+    if app.config.get("LOG_FORMAT", "json") == "json":
+        formatter = JsonFormatter(None, "%Y-%m-%d %H:%M:%S %z")
+    else:
+        formatter = logging.Formatter(
+            "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
+        )
+    for handler in handlers:
         handler.setFormatter(formatter)
+    # Move formatting and I/O off the request thread
+    if app.config.get("LOG_ASYNC", True) and handlers:
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(stop_listener, listener)
+        app.extensions["log_listener"] = listener
+        handlers = [ContextQueueHandler(log_queue)]
+    app.logger.handlers = handlers
+    for name, rate in parse_sampling(app.config.get("LOG_SAMPLING", "")).items():
+        logging.getLogger(name).addFilter(SamplingFilter(rate))
+    app.before_request(start_request)
+    app.after_request(finish_request)
     app.logger.info("Logging handler established")
+
+
+def stop_listener(listener):
+    """Flushes the queued records and stops the listener thread, once"""
+    if listener._thread is not None:  # pylint: disable=protected-access
+        listener.stop()
+
+
+def start_request():
+    """Assigns the request an id, reusing the caller's X-Request-ID"""
+    g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    g.request_start = time.perf_counter()
+
+
+def finish_request(response):
+    """Logs the outcome and duration of the request"""
+    request_id = g.get("request_id")
+    if request_id:
+        response.headers["X-Request-ID"] = request_id
+    logger = current_app.logger
+    if "request_start" in g and logger.isEnabledFor(logging.INFO):
+        duration_ms = round((time.perf_counter() - g.request_start) * 1000, 3)
+        logger.info(
+            "%s %s %s %.3fms", request.method, request.path, response.status_code, duration_ms,
+            extra={
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "duration_ms": duration_ms,
+            },
+        )
+    return response
@@ -0,0 +1,17 @@
+"""
+Metrics
+
+This module keeps a registry of runtime statistics providers so that
+every subsystem can report its counters through the /metrics endpoint
+"""
+_providers = {}
+
+
+def register(name: str, provider):
+    """Registers a callable that returns a dict of statistics under a name"""
+    _providers[name] = provider
+
+
+def snapshot() -> dict:
+    """Returns the current statistics of every registered provider"""
+    return {name: provider() for name, provider in sorted(_providers.items())}
@@ -0,0 +1,178 @@
+"""
+Profiling
+
+This module looks inside a running worker. The CPU profiler samples the
+stack of every thread on a background thread for a bounded time and
+reports collapsed stacks, the input of flamegraph.pl and speedscope. The
+heap profiler wraps tracemalloc to report what holds memory and what
+grew since tracing started.
+
+Neither costs anything until it is started: the sampler thread only
+exists while a profile runs and tracemalloc is stopped again afterwards.
+"""
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# Allocations of the profiler itself and of the import machinery are noise
+HEAP_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+HEAP_GROUPS = ("lineno", "filename", "traceback")
+
+
+def frame_label(frame) -> str:
+    """Names a stack frame module:function, as flame graphs expect"""
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}:{frame.f_code.co_name}".replace(";", ":").replace(" ", "_")
+
+
+class CpuProfiler:
+    """Samples the stacks of all other threads at a fixed interval"""
+
+    def __init__(self):
+        self.samples = Counter()
+        self.started_at = None
+        self.finished_at = None
+        self.seconds = 0
+        self.interval = 0
+        self.profiles = 0
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def running(self) -> bool:
+        """Returns True while a profile is being taken"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, interval) -> bool:
+        """Starts a profile of seconds length, False if one is already running"""
+        with self._lock:
+            if self.running():
+                return False
+            self.samples = Counter()
+            self.started_at, self.finished_at = time.time(), None
+            self.seconds, self.interval = seconds, interval
+            self.profiles += 1
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample, name="cpu-profiler", daemon=True)
+            self._thread.start()
+        return True
+
+    def stop(self):
+        """Ends the running profile early, keeping the samples taken so far"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def collapsed(self) -> str:
+        """Returns one 'root;...;leaf count' line per distinct stack"""
+        with self._lock:
+            samples = self.samples.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in samples)
+
+    def stats(self) -> dict:
+        """Returns the state of the last profile"""
+        with self._lock:
+            return {
+                "running": self.running(),
+                "profiles": self.profiles,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "seconds": self.seconds,
+                "interval": self.interval,
+                "samples": sum(self.samples.values()),
+            }
+
+    def _sample(self):
+        own = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if ident == own:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(frame_label(frame))
+                    frame = frame.f_back
+                labels.append(names.get(ident, "thread").replace(";", ":").replace(" ", "_"))
+                stacks.append(";".join(reversed(labels)))
+            with self._lock:
+                self.samples.update(stacks)
+            self._stop.wait(self.interval)
+        with self._lock:
+            self.finished_at = time.time()
+
+
+class HeapProfiler:
+    """Traces allocations with tracemalloc between start() and stop()"""
+
+    def __init__(self):
+        self.baseline = None
+
+    @staticmethod
+    def tracing() -> bool:
+        """Returns True while allocations are traced"""
+        return tracemalloc.is_tracing()
+
+    def start(self, frames) -> bool:
+        """Starts tracing with stacks of frames depth, False if already tracing"""
+        if tracemalloc.is_tracing():
+            return False
+        tracemalloc.start(frames)
+        self.baseline = tracemalloc.take_snapshot().filter_traces(HEAP_FILTERS)
+        return True
+
+    def stop(self):
+        """Stops tracing and frees the traces"""
+        tracemalloc.stop()
+        self.baseline = None
+
+    def top(self, limit, group_by="lineno", diff=False) -> dict:
+        """Returns the largest allocations, or the largest changes since start() when diff
+
+        Raises:
+            RuntimeError: when allocations are not traced
+        """
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("Heap tracing is not started")
+        snapshot = tracemalloc.take_snapshot().filter_traces(HEAP_FILTERS)
+        current, peak = tracemalloc.get_traced_memory()
+        if diff:
+            stats = [
+                dict(self._location(stat.traceback, group_by), size=stat.size, count=stat.count,
+                     size_diff=stat.size_diff, count_diff=stat.count_diff)
+                for stat in snapshot.compare_to(self.baseline, group_by)[:limit]
+            ]
+        else:
+            stats = [
+                dict(self._location(stat.traceback, group_by), size=stat.size, count=stat.count)
+                for stat in snapshot.statistics(group_by)[:limit]
+            ]
+        return {"traced_bytes": current, "peak_bytes": peak, "group_by": group_by, "diff": diff, "stats": stats}
+
+    def stats(self) -> dict:
+        """Returns whether allocations are traced and how much memory that costs"""
+        if not tracemalloc.is_tracing():
+            return {"tracing": False}
+        current, peak = tracemalloc.get_traced_memory()
+        return {"tracing": True, "traced_bytes": current, "peak_bytes": peak,
+                "overhead_bytes": tracemalloc.get_tracemalloc_memory()}
+
+    @staticmethod
+    def _location(traceback, group_by) -> dict:
+        if group_by == "traceback":
+            return {"traceback": [f"{frame.filename}:{frame.lineno}" for frame in traceback]}
+        frame = traceback[0]
+        return {"location": frame.filename if group_by == "filename" else f"{frame.filename}:{frame.lineno}"}
+
+
+cpu_profiler = CpuProfiler()
+heap_profiler = HeapProfiler()
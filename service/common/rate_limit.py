@@ -0,0 +1,213 @@
+"""
+Rate Limiting and Load Shedding
+
+This module throttles requests per client and route with token buckets
+and sheds load with 503_SERVICE_UNAVAILABLE when the worker is saturated
+"""
+import math
+import threading
+import time
+from flask import abort, g, request
+from service import app
+from service.models import db
+from . import metrics, status
+
+# Probes must keep answering while the worker is busy
+EXEMPT_ENDPOINTS = {"health", "ready", "static"}
+
+
+######################################################################
+#  T O K E N   B U C K E T S
+######################################################################
+class MemoryBackend:
+    """Token buckets kept in this process
+
+    Every backend implements take(); a backend that keeps its counters in
+    a shared store can be swapped in to enforce limits across replicas.
+    """
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate: float, burst: int, now: float) -> float:
+        """Takes a token from a bucket
+
+        Returns:
+            float: 0 if a token was taken, else the seconds until one is available
+        """
+        with self._lock:
+            tokens, last = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                self._prune(now)
+                return 0.0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / rate
+
+    def clear(self):
+        """Forgets every bucket"""
+        with self._lock:
+            self._buckets.clear()
+
+    def _prune(self, now):
+        """Drops idle buckets, they would be full again anyway"""
+        if len(self._buckets) <= self.max_keys:
+            return
+        for key, (_, last) in list(self._buckets.items()):
+            if now - last > 60:
+                del self._buckets[key]
+
+
+class RateLimiter:
+    """Applies a token bucket per client and route
+
+    Args:
+        rate (float): tokens added per second
+        burst (int): size of the bucket
+        routes (dict): endpoint name to (rate, burst) overrides
+        backend: where the buckets are stored, a MemoryBackend by default
+    """
+
+    def __init__(self, rate=50.0, burst=100, routes=None, backend=None, enabled=False):
+        self.rate = rate
+        self.burst = burst
+        self.routes = routes or {}
+        self.backend = backend or MemoryBackend()
+        self.enabled = enabled
+        self.clock = time.monotonic
+        self.allowed = 0
+        self.limited = 0
+
+    def check(self, client: str, endpoint: str) -> float:
+        """Returns 0 if the request may proceed, else the seconds to wait"""
+        rate, burst = self.routes.get(endpoint, (self.rate, self.burst))
+        retry_after = self.backend.take((client, endpoint), rate, burst, self.clock())
+        if retry_after:
+            self.limited += 1
+        else:
+            self.allowed += 1
+        return retry_after
+
+    def stats(self) -> dict:
+        """Returns the number of allowed and limited requests"""
+        return {"enabled": self.enabled, "allowed": self.allowed, "limited": self.limited}
+
+
+######################################################################
+#  L O A D   S H E D D I N G
+######################################################################
+class LoadShedder:
+    """Rejects requests once too many are in flight or the DB pool is exhausted
+
+    Args:
+        max_in_flight (int): concurrent requests allowed, 0 for no limit
+        pool: SQLAlchemy connection pool to watch, if any
+    """
+
+    def __init__(self, max_in_flight=0, pool=None):
+        self.max_in_flight = max_in_flight
+        self.pool = pool
+        self.in_flight = 0
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    def enter(self) -> bool:
+        """Admits a request, returns False if it must be shed"""
+        with self._lock:
+            if (self.max_in_flight and self.in_flight >= self.max_in_flight) or self._pool_exhausted():
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def exit(self):
+        """Releases a request admitted by enter()"""
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self) -> dict:
+        """Returns the number of requests in flight and shed"""
+        return {"in_flight": self.in_flight, "max_in_flight": self.max_in_flight, "shed": self.shed}
+
+    def _pool_exhausted(self):
+        """A new request would wait for a connection if the pool has none left"""
+        if self.pool is None or not hasattr(self.pool, "checkedout"):
+            return False
+        max_overflow = self.pool._max_overflow  # pylint: disable=protected-access
+        if max_overflow < 0:
+            return False  # unbounded pool
+        return self.pool.checkedout() >= self.pool.size() + max_overflow
+
+
+def parse_routes(value: str) -> dict:
+    """Parses 'endpoint=rate:burst,...' into a dict of overrides"""
+    routes = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        endpoint, limit = item.split("=")
+        rate, burst = limit.split(":")
+        routes[endpoint.strip()] = (float(rate), int(burst))
+    return routes
+
+
+limiter = RateLimiter(
+    rate=app.config["RATE_LIMIT_RATE"],
+    burst=app.config["RATE_LIMIT_BURST"],
+    routes=parse_routes(app.config["RATE_LIMIT_ROUTES"]),
+    enabled=app.config["RATE_LIMIT_ENABLED"],
+)
+shedder = LoadShedder(max_in_flight=app.config["SHED_MAX_IN_FLIGHT"])
+metrics.register("rate_limit", limiter.stats)
+metrics.register("load_shedding", shedder.stats)
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+@app.before_request
+def throttle_request():
+    """Rejects the request with 429 or 503 before it reaches its route"""
+    if request.endpoint in EXEMPT_ENDPOINTS:
+        return
+    if limiter.enabled:
+        retry_after = limiter.check(client_id(), request.endpoint)
+        if retry_after:
+            abort(
+                status.HTTP_429_TOO_MANY_REQUESTS,
+                "Rate limit exceeded",
+                retry_after=math.ceil(retry_after),
+            )
+    if shedder.pool is None and app.config["SHED_ON_POOL_EXHAUSTION"]:
+        shedder.pool = db.engine.pool
+    if not shedder.enter():
+        abort(
+            status.HTTP_503_SERVICE_UNAVAILABLE,
+            "Service is overloaded",
+            retry_after=app.config["SHED_RETRY_AFTER"],
+        )
+    g.admitted = True
+
+
+@app.teardown_request
+def release_request(_error=None):
+    """Releases the in-flight slot taken by throttle_request"""
+    if g.pop("admitted", False):
+        shedder.exit()
+
+
+def client_id() -> str:
+    """Identifies the caller by a configured header or the address the trusted proxies saw
+
+    Entries a client puts in X-Forwarded-For itself come before those of
+    the proxies, so only the entry of the outermost trusted proxy counts.
+    """
+    header = app.config["RATE_LIMIT_CLIENT_HEADER"]
+    if header and request.headers.get(header):
+        return request.headers[header].split(",")[-1].strip()  # the entry of the nearest proxy
+    hops = app.config["RATE_LIMIT_TRUSTED_PROXIES"]
+    forwarded = [entry.strip() for entry in request.headers.get("X-Forwarded-For", "").split(",") if entry.strip()]
+    if hops and len(forwarded) >= hops:
+        return forwarded[-hops]
+    return request.remote_addr or "unknown"
@@ -0,0 +1,174 @@
+"""
+Sharding
+
+This module spreads accounts over several databases. Every shard holds
+the whole schema, an account and its change log and row count live on
+the shard a consistent hash of the account id picks, so writes to one
+account stay in one transaction. The database of DATABASE_URI keeps
+what is not sharded: the jobs and the id allocator.
+
+Models pick a shard with ``router.on(shard)``, db.session then reads and
+writes that shard. Each thread gets one session per shard.
+"""
+import bisect
+import contextvars
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import current_app
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm
+
+# The shard the current thread or request works on, None for DATABASE_URI
+current_shard = contextvars.ContextVar("current_shard", default=None)
+
+
+class ShardSession(SignallingSession):
+    """A session bound to the database of the shard current when it is created"""
+
+    def __init__(self, db, **options):  # pylint: disable=invalid-name
+        self.shard = current_shard.get()
+        if self.shard is not None:
+            options["bind"] = db.get_engine(db.get_app(), bind=self.shard)
+            options["binds"] = {}
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **_kwargs):  # pylint: disable=arguments-differ
+        if bind is not None:
+            return bind
+        if self.shard is not None:
+            return self.bind
+        return super().get_bind(mapper, clause)
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with db.session scoped to the thread and the current shard"""
+
+    def __init__(self, **kwargs):
+        session_options = kwargs.setdefault("session_options", {})
+        session_options.setdefault("scopefunc", lambda: (threading.get_ident(), current_shard.get()))
+        super().__init__(**kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=ShardSession, db=self, **options)
+
+
+class HashRing:
+    """Consistent hash ring, adding a shard only moves about 1/N of the keys
+
+    Args:
+        shards (list): the names of the shards
+        replicas (int): points per shard on the ring, more spread keys more evenly
+    """
+
+    def __init__(self, shards, replicas=64):
+        points = sorted((self.hash(f"{shard}#{replica}"), shard) for shard in shards for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    @staticmethod
+    def hash(key: str) -> int:
+        """Returns a stable 64 bit hash of a key"""
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def shard_for(self, key):
+        """Returns the shard that owns a key"""
+        index = bisect.bisect(self._hashes, self.hash(str(key))) % len(self._hashes)
+        return self._shards[index]
+
+
+class ShardRouter:
+    """Routes account ids to shards and runs work on each shard
+
+    Unsharded, the only shard is None, which is the DATABASE_URI database,
+    so code written against the router runs unchanged on one database.
+    """
+
+    def __init__(self):
+        self.shards = [None]
+        self.db = None
+        self._ring = None
+        self._pool = None
+
+    @property
+    def sharded(self) -> bool:
+        """True if accounts are spread over several databases"""
+        return self._ring is not None
+
+    def init_app(self, app, db):  # pylint: disable=invalid-name
+        """Reads the shards from SQLALCHEMY_BINDS and removes their sessions after each request"""
+        self.db = db
+        self.configure(sorted(app.config.get("SQLALCHEMY_BINDS") or {}, key=_shard_order))
+        if self.remove_sessions not in app.teardown_appcontext_funcs:
+            app.teardown_appcontext(self.remove_sessions)
+
+    def configure(self, shards):
+        """Sets the shards, none to keep everything in DATABASE_URI
+
+        Shards are named after their SQLALCHEMY_BINDS key. Renaming one
+        moves the accounts it owns.
+        """
+        if self._pool:
+            self._pool.shutdown(wait=False)
+        self.shards = list(shards) or [None]
+        self._ring = HashRing(self.shards) if shards else None
+        self._pool = ThreadPoolExecutor(len(self.shards), thread_name_prefix="shard") if shards else None
+
+    @staticmethod
+    def current():
+        """Returns the shard db.session points at"""
+        return current_shard.get()
+
+    def shard_for(self, account_id):
+        """Returns the shard that owns an id"""
+        return self._ring.shard_for(account_id) if self._ring else None
+
+    def targets(self):
+        """Returns the shards a query must visit, only the current one when nested"""
+        if not self.sharded or current_shard.get() is not None:
+            return [current_shard.get()]
+        return list(self.shards)
+
+    @contextmanager
+    def on(self, shard):
+        """Points db.session at a shard for the duration of the block"""
+        token = current_shard.set(shard)
+        try:
+            yield shard
+        finally:
+            current_shard.reset(token)
+
+    def gather(self, func):
+        """Calls func on every shard in parallel and returns the results in shard order
+
+        Records loaded by func are detached from their session once it
+        returns, use them for reading only.
+        """
+        shards = self.targets()
+        if len(shards) == 1:
+            with self.on(shards[0]):
+                return [func()]
+        app = current_app._get_current_object()  # pylint: disable=protected-access
+
+        def call(shard):
+            with app.app_context(), self.on(shard):
+                return func()
+
+        return list(self._pool.map(call, shards))
+
+    def remove_sessions(self, _error=None):
+        """Closes the sessions the current thread opened on each shard"""
+        for shard in self.shards:
+            if shard is not None:
+                with self.on(shard):
+                    self.db.session.remove()
+
+
+def _shard_order(name):
+    """Sorts shard0, shard1, ... shard10 by number"""
+    digits = name.lstrip("abcdefghijklmnopqrstuvwxyz_-")
+    return (int(digits) if digits.isdigit() else 0, name)
+
+
+router = ShardRouter()
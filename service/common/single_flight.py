@@ -0,0 +1,73 @@
+"""
+Single Flight
+
+This module lets concurrent identical reads share one execution. The
+first caller for a key runs the query, every caller that arrives while
+it is still running waits for and receives the same result.
+"""
+import threading
+
+
+class _Call:
+    """A call in flight and the result its waiters will receive"""
+
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key
+
+    Results are handed to several threads, so they must not be mutated
+    by the callers (serialized dicts and encoded bytes are safe).
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executions = 0
+        self.coalesced = 0
+
+    def do(self, key, func):
+        """Returns func(), or the result of the identical call already in flight"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executions += 1
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+        if leader:
+            return self._lead(key, call, func)
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self) -> dict:
+        """Returns how many calls were executed and how many were coalesced"""
+        return {
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._calls),
+        }
+
+    def _lead(self, key, call, func):
+        """Runs func for every caller of key"""
+        try:
+            call.result = func()
+            return call.result
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
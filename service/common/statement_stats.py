@@ -0,0 +1,60 @@
+"""
+Statement Cache Statistics
+
+This module counts how often SQLAlchemy reused a compiled statement from
+the engine's compiled cache instead of compiling it again, so that a
+query that defeats the cache shows up in /metrics
+"""
+import threading
+from sqlalchemy import event
+from sqlalchemy.engine import default
+
+# Outcomes reported by ExecutionContext.cache_hit
+OUTCOMES = {
+    default.CACHE_HIT: "hits",
+    default.CACHE_MISS: "misses",
+    default.CACHING_DISABLED: "disabled",
+    default.NO_CACHE_KEY: "uncacheable",
+    default.NO_DIALECT_SUPPORT: "unsupported",
+}
+
+
+class StatementStats:
+    """Counts the compiled cache outcome of every statement executed on an engine"""
+
+    def __init__(self):
+        self.engine = None
+        self._counts = dict.fromkeys(OUTCOMES.values(), 0)
+        self._lock = threading.Lock()
+
+    def attach(self, engine):
+        """Starts counting the statements executed on an engine"""
+        if self.engine is not None:
+            event.remove(self.engine, "before_cursor_execute", self.record)
+        self.engine = engine
+        event.listen(engine, "before_cursor_execute", self.record)
+
+    def record(self, _conn, _cursor, _statement, _parameters, context, _executemany):
+        """Event hook, counts the outcome of one execution"""
+        outcome = OUTCOMES.get(getattr(context, "cache_hit", None), "uncacheable")
+        with self._lock:
+            self._counts[outcome] += 1
+
+    def reset(self):
+        """Zeroes the counters"""
+        with self._lock:
+            self._counts = dict.fromkeys(OUTCOMES.values(), 0)
+
+    def stats(self) -> dict:
+        """Returns the outcome counters and the size of the compiled cache"""
+        with self._lock:
+            counts = dict(self._counts)
+        lookups = counts["hits"] + counts["misses"]
+        counts["hit_ratio"] = round(counts["hits"] / lookups, 4) if lookups else 0.0
+        cache = getattr(self.engine, "_compiled_cache", None)
+        counts["entries"] = len(cache) if cache is not None else 0
+        counts["capacity"] = cache.capacity if cache is not None else 0
+        return counts
+
+
+statement_stats = StatementStats()
@@ -0,0 +1,112 @@
+"""
+Trigram Index
+
+This module contains an in-process n-gram index that ranks documents the
+way Postgres pg_trgm does. It stands in for the pg_trgm GIN indexes on
+databases without the extension, such as SQLite in development.
+"""
+import heapq
+import re
+import threading
+from collections import Counter, defaultdict
+
+WORD = re.compile(r"[^\W_]+")
+
+
+def trigrams(value: str) -> set:
+    """Returns the trigrams of a string, each word padded like pg_trgm does"""
+    grams = set()
+    for word in WORD.findall(value.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def inner_trigrams(value: str) -> set:
+    """Returns the unpadded trigrams of the words, every substring match contains them"""
+    return {word[i:i + 3] for word in WORD.findall(value.lower()) for i in range(len(word) - 2)}
+
+
+def similarity(left: set, right: set) -> float:
+    """Returns the share of trigrams two strings have in common"""
+    if not left or not right:
+        return 0.0
+    shared = len(left & right)
+    return shared / (len(left) + len(right) - shared)
+
+
+class TrigramIndex:
+    """Maps trigrams to the documents that contain them
+
+    A document is an id with a few text fields. A match scores the best
+    similarity of the query to any field, plus 1 if a field contains the
+    query as a substring, so substring matches always rank first.
+
+    The token attribute is free for the owner to track how far the index
+    has been synchronized.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.token = None
+        self._postings = defaultdict(set)
+        self._docs = {}
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, doc_id, *fields):
+        """Indexes a document, replacing its previous version"""
+        self.remove(doc_id)
+        texts = tuple((field or "").lower() for field in fields)
+        grams = tuple(trigrams(text) for text in texts)
+        self._docs[doc_id] = (texts, grams)
+        for gram in set().union(*grams):
+            self._postings[gram].add(doc_id)
+
+    def remove(self, doc_id):
+        """Drops a document from the index"""
+        doc = self._docs.pop(doc_id, None)
+        if doc is None:
+            return
+        for gram in set().union(*doc[1]):
+            postings = self._postings[gram]
+            postings.discard(doc_id)
+            if not postings:
+                del self._postings[gram]
+
+    def clear(self):
+        """Drops every document"""
+        self._postings.clear()
+        self._docs.clear()
+        self.token = None
+
+    def search(self, query: str, limit: int, threshold: float):
+        """Returns up to limit (doc_id, score) pairs scoring at least threshold, best first"""
+        query_grams = trigrams(query)
+        needle = query.lower().strip()
+        shared = Counter()
+        for gram in query_grams:
+            shared.update(self._postings.get(gram, ()))
+        # the similarity to a field can never exceed shared / len(query_grams)
+        candidates = {
+            doc_id for doc_id, count in shared.items() if count >= threshold * len(query_grams)
+        }
+        candidates |= self._containing(inner_trigrams(needle))
+        scored = []
+        for doc_id in candidates:
+            texts, grams = self._docs[doc_id]
+            score = max(similarity(query_grams, field) for field in grams)
+            if needle and any(needle in text for text in texts):
+                score += 1
+            if score >= threshold and score > 0:
+                scored.append((round(score, 4), doc_id))
+        best = heapq.nsmallest(limit, scored, key=lambda match: (-match[0], match[1]))
+        return [(doc_id, score) for score, doc_id in best]
+
+    def _containing(self, grams):
+        """Returns the documents that have every one of the trigrams"""
+        if not grams:
+            return set()  # a short query could only be checked by scanning, it gets fuzzy matches only
+        postings = sorted((self._postings.get(gram, set()) for gram in grams), key=len)
+        return set(postings[0]).intersection(*postings[1:])
@@ -18,6 +18,118 @@ if not DATABASE_URI:
 # Configure SQLAlchemy
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+# Compiled statements kept per engine, see the statement_cache metrics
+SQLALCHEMY_ENGINE_OPTIONS = {"query_cache_size": int(os.getenv("SQL_QUERY_CACHE_SIZE", "500"))}
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
+
+# Cache of encoded GET /accounts responses, invalidated on every write.
+# The TTL bounds staleness when another worker or replica writes.
+LIST_CACHE_MAX_ENTRIES = int(os.getenv("LIST_CACHE_MAX_ENTRIES", "256"))
+LIST_CACHE_MAX_BYTES = int(os.getenv("LIST_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+LIST_CACHE_TTL = float(os.getenv("LIST_CACHE_TTL", "5"))
+LIST_CACHE_GZIP_MIN_BYTES = int(os.getenv("LIST_CACHE_GZIP_MIN_BYTES", "1024"))
+
+# Token bucket rate limiting per client and route. RATE_LIMIT_ROUTES
+# overrides the default per endpoint, e.g. "list_accounts=5:10".
+# Clients are told apart by RATE_LIMIT_CLIENT_HEADER when a trusted proxy
+# sets it, else by their address. Behind RATE_LIMIT_TRUSTED_PROXIES proxies
+# that append to X-Forwarded-For (1 for an ingress) that address is the
+# entry the outermost of them wrote, entries further left are the client's
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "false").lower() == "true"
+RATE_LIMIT_RATE = float(os.getenv("RATE_LIMIT_RATE", "50"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "100"))
+RATE_LIMIT_ROUTES = os.getenv("RATE_LIMIT_ROUTES", "")
+RATE_LIMIT_CLIENT_HEADER = os.getenv("RATE_LIMIT_CLIENT_HEADER", "")
+RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "0"))
+
+# Load shedding: answer 503 once this many requests are in flight
+# (0 disables it) or when the database connection pool is exhausted
+SHED_MAX_IN_FLIGHT = int(os.getenv("SHED_MAX_IN_FLIGHT", "0"))
+SHED_ON_POOL_EXHAUSTION = os.getenv("SHED_ON_POOL_EXHAUSTION", "true").lower() == "true"
+SHED_RETRY_AFTER = int(os.getenv("SHED_RETRY_AFTER", "1"))
+
+# Logging: "json" or "text" lines, written by a background thread when
+# LOG_ASYNC is on. LOG_SAMPLING keeps a fraction of the INFO lines of a
+# logger, e.g. "flask.app=0.1"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_ASYNC = os.getenv("LOG_ASYNC", "true").lower() == "true"
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+
+# Most account ids resolved by one batch lookup request
+BATCH_LOOKUP_MAX_IDS = int(os.getenv("BATCH_LOOKUP_MAX_IDS", "5000"))
+
+# Most accounts changed per transaction by PATCH and DELETE /accounts
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+
+# Change feed: most changes per page, how long one SSE stream stays open
+# and how often it polls for writes made by other workers
+CHANGE_FEED_PAGE_SIZE = int(os.getenv("CHANGE_FEED_PAGE_SIZE", "500"))
+CHANGE_STREAM_MAX_SECONDS = float(os.getenv("CHANGE_STREAM_MAX_SECONDS", "300"))
+CHANGE_STREAM_POLL_SECONDS = float(os.getenv("CHANGE_STREAM_POLL_SECONDS", "5"))
+
+# Postgres only: create the account table partitioned by year of
+# date_joined, starting at ACCOUNT_PARTITION_START_YEAR. Takes effect
+# when the table is first created. flask db-archive moves cold accounts
+# to account_archive in batches of ARCHIVE_BATCH_SIZE
+ACCOUNT_PARTITIONING = os.getenv("ACCOUNT_PARTITIONING", "false").lower() == "true"
+ACCOUNT_PARTITION_START_YEAR = int(os.getenv("ACCOUNT_PARTITION_START_YEAR", "2008"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "5000"))
+
+# How HEAD /accounts counts when no ?count= mode is given:
+# "exact", "estimate" (Postgres planner statistics) or "cached"
+COUNT_MODE_DEFAULT = os.getenv("COUNT_MODE_DEFAULT", "cached")
+
+# Account search: results per request and the least similarity of a
+# fuzzy match (substring matches are always returned)
+SEARCH_DEFAULT_LIMIT = int(os.getenv("SEARCH_DEFAULT_LIMIT", "20"))
+SEARCH_MAX_LIMIT = int(os.getenv("SEARCH_MAX_LIMIT", "100"))
+SEARCH_DEFAULT_THRESHOLD = float(os.getenv("SEARCH_DEFAULT_THRESHOLD", "0.3"))
+
+# Background jobs: worker threads per process (0 runs each job inside the
+# request that submits it) and most jobs queued or running at once. The
+# process running a job refreshes its heartbeat every JOB_HEARTBEAT_SECONDS,
+# a job without one for JOB_STALE_SECONDS is failed as abandoned
+JOB_MAX_WORKERS = int(os.getenv("JOB_MAX_WORKERS", "2"))
+JOB_MAX_UNFINISHED = int(os.getenv("JOB_MAX_UNFINISHED", "20"))
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "10"))
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "60"))
+
+# Sharding: a comma separated list of database URIs to spread accounts
+# over by a consistent hash of their id. DATABASE_URI then keeps only the
+# jobs and the id allocator, which hands out ids in blocks of
+# SHARD_ID_BLOCK_SIZE. Empty keeps everything in DATABASE_URI
+SHARD_DATABASE_URIS = [uri.strip() for uri in os.getenv("SHARD_DATABASE_URIS", "").split(",") if uri.strip()]
+SQLALCHEMY_BINDS = {f"shard{number}": uri for number, uri in enumerate(SHARD_DATABASE_URIS)}
+SHARD_ID_BLOCK_SIZE = int(os.getenv("SHARD_ID_BLOCK_SIZE", "1000"))
+
+# Admin endpoints under /admin, such as profiling, need the header
+# "Authorization: Bearer <ADMIN_TOKEN>". They answer 404 when it is empty.
+# CPU profiles last at most PROFILE_MAX_SECONDS and sample every
+# PROFILE_INTERVAL seconds, heap tracing keeps TRACEMALLOC_FRAMES frames
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILE_DEFAULT_SECONDS = float(os.getenv("PROFILE_DEFAULT_SECONDS", "10"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))
+TRACEMALLOC_FRAMES = int(os.getenv("TRACEMALLOC_FRAMES", "10"))
+
+# Worker lifecycle: before turning ready a new worker opens
+# WARMUP_CONNECTIONS pool connections per database and sends each of
+# WARMUP_PATHS ("path" or "METHOD path") through the app. On SIGTERM it
+# turns unready and waits up to DRAIN_TIMEOUT seconds for the requests in
+# flight, keep this below gunicorn's graceful timeout
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "5"))
+WARMUP_PATHS = os.getenv(
+    "WARMUP_PATHS", "/account/0,/accounts?ids=0,HEAD /accounts,/accounts/stats,/accounts/search?q=warm-up"
+)
+DRAIN_ON_SIGTERM = os.getenv("DRAIN_ON_SIGTERM", "true").lower() == "true"
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "25"))
+
+# Duplicate emails: a Bloom filter of every email, sized for twice the
+# accounts and at least EMAIL_FILTER_MIN_CAPACITY, lets a create skip the
+# lookup of an email it proves new. A unique index on lower(email) catches
+# what the filter of another worker has not seen yet
+EMAIL_FILTER_ERROR_RATE = float(os.getenv("EMAIL_FILTER_ERROR_RATE", "0.01"))
+EMAIL_FILTER_MIN_CAPACITY = int(os.getenv("EMAIL_FILTER_MIN_CAPACITY", "100000"))
@@ -3,31 +3,570 @@ Models for Account
 
 All of the models are stored in this module
 """
+import heapq
 import logging
-from datetime import date
-from flask_sqlalchemy import SQLAlchemy
+import re
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime
+from sqlalchemy import MetaData, any_, bindparam, delete, event, inspect, literal, select, text, union_all, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.orm import Session
+from service.common.bloom import BloomFilter
+from service.common.sharding import ShardedSQLAlchemy, router
+from service.common.statement_stats import statement_stats
+from service.common.trigram import TrigramIndex, inner_trigrams
 
 logger = logging.getLogger("flask.app")
 
+# SQLite limits the number of bound parameters in one statement
+SQLITE_MAX_IDS_PER_QUERY = 500
+
+# Unique index on lower(email), see create_email_index()
+EMAIL_INDEX = "ix_account_email_lower"
+
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = ShardedSQLAlchemy()
+
+
+# Notified after every committed write, wakes up change streams
+changes_committed = threading.Condition()
+
+# Back Account.search where Postgres pg_trgm is not available, one per shard
+search_indexes = defaultdict(TrigramIndex)
 
 
 class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
 
 
+class DuplicateEmailError(DataValidationError):
+    """Used when an email already belongs to another Account"""
+
+
 def init_db(app):
     """Initialize the SQLAlchemy app"""
     Account.init_db(app)
 
 
+def dialect_name():
+    """Returns the database dialect of the current shard"""
+    return db.session.get_bind().dialect.name
+
+
+def dialect_names():
+    """Returns the database dialects of every shard"""
+    return {db.get_engine(bind=shard).dialect.name for shard in router.shards}
+
+
+@contextmanager
+def rollback_on_error():
+    """Rolls db.session back if the block raises, so the session stays usable"""
+    try:
+        yield
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+######################################################################
+#  C H A N G E   L O G
+######################################################################
+class ChangeLog(db.Model):
+    """
+    One row per committed write, read in (txid, id) order by the change feed
+
+    Postgres hands ids out at insert but transactions commit in any order,
+    so a change with a lower id can still become visible after a consumer
+    read past it. Every change is also stamped with the id of its
+    transaction, the feed is read in that order and only serves changes of
+    transactions older than the oldest one still open, which can never be
+    joined by another change before them. SQLite commits one transaction at
+    a time and leaves txid at 0, its tokens are plain ids.
+    """
+
+    UPSERT = "upsert"
+    DELETE = "delete"
+
+    # A sync token packs the txid above the id of the change
+    TOKEN_ID_BITS = 32
+    TOKEN_ID_MASK = (1 << TOKEN_ID_BITS) - 1
+    # txid is a BIGINT, no token above this can name a change
+    MAX_TOKEN = ((1 << 63) << TOKEN_ID_BITS) - 1
+
+    __tablename__ = "change_log"
+    # SQLite reuses the ids of deleted rows without AUTOINCREMENT, tokens must never go back
+    __table_args__ = (
+        db.Index("ix_change_log_resource_txid_id", "resource", "txid", "id"),
+        {"sqlite_autoincrement": True},
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    # txid_current() on Postgres, see create_change_log_txid()
+    txid = db.Column(db.BigInteger, nullable=False, server_default=text("0"))
+    resource = db.Column(db.String(32), nullable=False)
+    resource_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(8), nullable=False)
+    changed_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<ChangeLog {self.operation} {self.resource}[{self.resource_id}] token=[{self.token}]>"
+
+    @property
+    def token(self):
+        """The sync token of this change"""
+        return (self.txid << self.TOKEN_ID_BITS) | self.id
+
+    @classmethod
+    def after(cls, token):
+        """Returns a criterion matching the changes that follow a sync token"""
+        txid, change_id = token >> cls.TOKEN_ID_BITS, token & cls.TOKEN_ID_MASK
+        return db.or_(cls.txid > txid, db.and_(cls.txid == txid, cls.id > change_id))
+
+    @classmethod
+    def settled(cls):
+        """Returns the criteria of the changes no open transaction can precede
+
+        A transaction left open on Postgres holds the feed back until it ends.
+        """
+        if dialect_name() == "postgresql":
+            return [cls.txid < db.func.txid_snapshot_xmin(db.func.txid_current_snapshot())]
+        return []
+
+    @classmethod
+    def latest_token(cls, resource):
+        """Returns the token of the last settled change to a resource, 0 if there is none"""
+        change = db.session.scalars(
+            select(cls)
+            .where(cls.resource == resource, *cls.settled())
+            .order_by(cls.txid.desc(), cls.id.desc())
+            .limit(1)
+        ).first()
+        return change.token if change else 0
+
+    @classmethod
+    def is_pruned(cls, resource, token):
+        """Returns True if changes to a resource that follow a token may have been pruned"""
+        first_id = db.session.scalar(select(db.func.min(cls.id)).where(cls.resource == resource))
+        return first_id is not None and (token & cls.TOKEN_ID_MASK) + 1 < first_id
+
+    @classmethod
+    def prune(cls, before):
+        """Deletes the changes made before a point in time
+
+        Args:
+            before (datetime): changes older than this are removed
+
+        Returns:
+            int: the number of changes removed
+        """
+        logger.info("Pruning changes made before %s", before)
+        count = 0
+        for shard in router.targets():
+            with router.on(shard):
+                count += db.session.execute(
+                    delete(cls).where(cls.changed_at < before).execution_options(synchronize_session=False)
+                ).rowcount
+                db.session.commit()
+        return count
+
+
+######################################################################
+#  R O W   C O U N T S
+######################################################################
+class RowCount(db.Model):
+    """
+    Row count of a table kept up to date by every write, read by ?count=cached
+
+    Writers update the counter in their own transaction, so concurrent
+    creates and deletes queue on its row lock until they commit.
+    """
+
+    __tablename__ = "row_count"
+
+    table_name = db.Column(db.String(64), primary_key=True)
+    total = db.Column(db.BigInteger(), nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<RowCount {self.table_name}={self.total}>"
+
+    @classmethod
+    def add(cls, table_name, delta):
+        """Adjusts the count of a table in the current transaction"""
+        db.session.execute(
+            cls.__table__.update()
+            .where(cls.table_name == table_name)
+            .values(total=cls.total + delta)
+        )
+
+    @classmethod
+    def get(cls, table_name):
+        """Returns the count of a table"""
+        return db.session.scalar(select(cls.total).where(cls.table_name == table_name))
+
+    @classmethod
+    def ensure(cls, model):
+        """Starts counting a table with its exact number of rows"""
+        if cls.get(model.__tablename__) is None:
+            try:
+                db.session.add(cls(table_name=model.__tablename__, total=model.count("exact")[0]))
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()  # another process got there first
+
+
+######################################################################
+#  D A I L Y   R O L L U P S
+######################################################################
+class DailyRollup(db.Model):
+    """
+    Number of rows of a table per day of its rollup column, kept up to
+    date by every write so histograms never scan the table itself
+
+    Writes through the models adjust it in their own transaction. Query
+    level deletes do not, rebuild() recounts the table.
+    """
+
+    __tablename__ = "daily_rollup"
+
+    # Upserts that add to the total of an existing day
+    INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+    PERIODS = ("day", "month", "year")
+
+    table_name = db.Column(db.String(64), primary_key=True)
+    day = db.Column(db.Date(), primary_key=True)
+    total = db.Column(db.BigInteger(), nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<DailyRollup {self.table_name} {self.day}={self.total}>"
+
+    @classmethod
+    def add(cls, table_name, days, session=None):
+        """Adjusts the totals of some days in the current transaction
+
+        Args:
+            table_name (string): the table the days count rows of
+            days (Counter): the change of the total of each day
+            session: the session of the transaction, db.session by default
+        """
+        rows = [{"table_name": table_name, "day": day, "total": delta} for day, delta in days.items() if delta]
+        if not rows:
+            return
+        session = session or db.session
+        insert = cls.INSERTS.get(session.get_bind().dialect.name)
+        if insert is None:
+            for row in rows:
+                if not session.execute(
+                    cls.__table__.update()
+                    .where(cls.table_name == table_name, cls.day == row["day"])
+                    .values(total=cls.total + row["total"])
+                ).rowcount:
+                    session.execute(cls.__table__.insert().values(**row))
+            return
+        statement = insert(cls.__table__).values(rows)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=["table_name", "day"], set_={"total": cls.__table__.c.total + statement.excluded.total}
+        ))
+
+    @classmethod
+    def histogram(cls, table_name, period, start=None, end=None):
+        """Returns the totals per period of the days in a range, across every shard
+
+        Args:
+            table_name (string): the table the days count rows of
+            period (string): "day", "month" or "year"
+            start (date): earliest day, inclusive
+            end (date): latest day, exclusive
+
+        Returns:
+            list: (period label, total) pairs in period order, empty periods left out
+        """
+        query = select(cls.day, cls.total).where(cls.table_name == table_name, cls.total != 0)
+        if start is not None:
+            query = query.where(cls.day >= start)
+        if end is not None:
+            query = query.where(cls.day < end)
+        width = {"day": 10, "month": 7, "year": 4}[period]
+        buckets = Counter()
+        for rows in router.gather(lambda: db.session.execute(query).all()):
+            for day, total in rows:
+                buckets[day.isoformat()[:width]] += total
+        return [(label, total) for label, total in sorted(buckets.items()) if total]
+
+    @classmethod
+    def rebuild(cls, table_name, column_name, tables, only_empty=False):
+        """Recounts the days of a table from scratch, on every shard
+
+        Rebuilds of one table take turns on a Postgres advisory lock, so
+        workers starting together never insert the same days twice.
+
+        Args:
+            table_name (string): the table the days count rows of
+            column_name (string): the date column rolled up
+            tables (list): the tables whose rows are counted
+            only_empty (bool): skip shards that already have days, once
+                the lock is held
+
+        Returns:
+            int: the number of rows counted
+        """
+        logger.info("Rebuilding the daily rollup of %s", table_name)
+        counted = 0
+        for shard in router.targets():
+            with router.on(shard):
+                if dialect_name() == "postgresql":
+                    db.session.execute(select(db.func.pg_advisory_xact_lock(
+                        db.func.hashtext(f"{cls.__tablename__}:{table_name}")
+                    )))
+                if only_empty and not cls.is_empty(table_name):
+                    db.session.commit()  # rebuilt by another worker meanwhile
+                    continue
+                days = union_all(*(select(table.c[column_name].label("day")) for table in tables)).subquery()
+                rows = select(literal(table_name), days.c.day, db.func.count()).group_by(days.c.day)
+                db.session.execute(delete(cls).where(cls.table_name == table_name))
+                db.session.execute(cls.__table__.insert().from_select(["table_name", "day", "total"], rows))
+                counted += db.session.scalar(
+                    select(db.func.coalesce(db.func.sum(cls.total), 0)).where(cls.table_name == table_name)
+                )
+                db.session.commit()
+        return counted
+
+    @classmethod
+    def is_empty(cls, table_name):
+        """Returns True if the current shard has no days of a table"""
+        return db.session.scalar(select(cls.day).where(cls.table_name == table_name).limit(1)) is None
+
+
+######################################################################
+#  I D   A L L O C A T I O N
+######################################################################
+class IdBlock(db.Model):
+    """
+    Hands out blocks of ids for a sharded table, so that ids stay unique
+    across shards. Lives in DATABASE_URI, every process reserves a block
+    at a time and assigns the ids of it without a round trip.
+    """
+
+    __tablename__ = "id_block"
+
+    table_name = db.Column(db.String(64), primary_key=True)
+    next_id = db.Column(db.BigInteger(), nullable=False)
+
+    # Ids reserved by this process: table name to [next, end)
+    _reserved = {}
+    _lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<IdBlock {self.table_name} next=[{self.next_id}]>"
+
+    @classmethod
+    def next_ids(cls, table_name, count):
+        """Returns count unused ids for a table"""
+        ids = []
+        with cls._lock:
+            while len(ids) < count:
+                start, end = cls._reserved.get(table_name, (0, 0))
+                if start == end:
+                    start, end = cls._reserve(table_name, max(count - len(ids), cls.block_size()))
+                taken = min(end - start, count - len(ids))
+                ids.extend(range(start, start + taken))
+                cls._reserved[table_name] = (start + taken, end)
+        return ids
+
+    @classmethod
+    def ensure(cls, table_name, start):
+        """Starts handing out ids of a table at start, unless it already is"""
+        try:
+            with db.engine.begin() as connection:
+                if connection.scalar(select(cls.next_id).where(cls.table_name == table_name)) is None:
+                    connection.execute(cls.__table__.insert().values(table_name=table_name, next_id=start))
+        except IntegrityError:
+            pass  # another process got there first
+
+    @classmethod
+    def block_size(cls):
+        """Ids reserved per round trip to DATABASE_URI"""
+        return Account.app.config["SHARD_ID_BLOCK_SIZE"]
+
+    @classmethod
+    def _reserve(cls, table_name, size):
+        """Moves the counter past a block in its own transaction and returns the block"""
+        with db.engine.begin() as connection:
+            connection.execute(
+                update(cls.__table__).where(cls.table_name == table_name).values(next_id=cls.next_id + size)
+            )
+            end = connection.scalar(select(cls.next_id).where(cls.table_name == table_name))
+        return end - size, end
+
+
+######################################################################
+#  J O B S
+######################################################################
+class Job(db.Model):
+    """
+    A long-running operation executed off the request path by a job runner
+
+    The process that accepts a Job owns it and keeps its heartbeat fresh
+    until it finishes. A Job whose heartbeat stops was left behind by a
+    process that died and is failed by fail_stale().
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+    __tablename__ = "job"
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default=QUEUED, index=True)
+    params = db.Column(db.JSON, nullable=False, default=dict)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    result = db.Column(db.JSON)
+    error = db.Column(db.Text)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    owner = db.Column(db.String(128))
+    heartbeat_at = db.Column(db.DateTime())
+    created_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime())
+    finished_at = db.Column(db.DateTime())
+
+    def __repr__(self):
+        return f"<Job {self.kind} id=[{self.id}] {self.status}>"
+
+    def serialize(self):
+        """Serializes a Job into a dictionary"""
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": self.progress,
+            "total": self.total,
+            "result": self.result,
+            "error": self.error,
+            "cancel_requested": self.cancel_requested,
+            "owner": self.owner,
+            "heartbeat_at": self.heartbeat_at.isoformat() if self.heartbeat_at else None,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+    @classmethod
+    def find(cls, job_id):
+        """Finds a Job by its ID"""
+        return db.session.get(cls, job_id)
+
+    @classmethod
+    def unfinished(cls):
+        """Returns the number of Jobs queued or running"""
+        return db.session.scalar(select(db.func.count(cls.id)).where(cls.status.in_((cls.QUEUED, cls.RUNNING))))
+
+    @classmethod
+    def heartbeat(cls, owner):
+        """Marks the unfinished Jobs of an owner as still alive"""
+        db.session.execute(
+            update(cls)
+            .where(cls.owner == owner, cls.status.in_((cls.QUEUED, cls.RUNNING)))
+            .values(heartbeat_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+    @classmethod
+    def fail_stale(cls, before):
+        """Fails the unfinished Jobs whose last heartbeat is older than a point in time
+
+        Args:
+            before (datetime): Jobs that have not sent a heartbeat since are failed
+
+        Returns:
+            int: the number of Jobs failed
+        """
+        failed = db.session.execute(
+            update(cls)
+            .where(
+                cls.status.in_((cls.QUEUED, cls.RUNNING)),
+                db.func.coalesce(cls.heartbeat_at, cls.created_at) < before,
+            )
+            .values(status=cls.FAILED, error="Abandoned by a worker that stopped", finished_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        return failed
+
+    @classmethod
+    def is_cancel_requested(cls, job_id):
+        """Reads the cancellation flag as committed by another session"""
+        return bool(db.session.scalar(select(cls.cancel_requested).where(cls.id == job_id)))
+
+
+class JobResult(db.Model):
+    """
+    One chunk of the result file of a Job, kept next to the Job so that
+    every replica can serve it
+    """
+
+    __tablename__ = "job_result"
+
+    job_id = db.Column(db.Integer, db.ForeignKey("job.id", ondelete="CASCADE"), primary_key=True)
+    seq = db.Column(db.Integer, primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+
+    def __repr__(self):
+        return f"<JobResult job=[{self.job_id}] seq=[{self.seq}]>"
+
+    @classmethod
+    def append(cls, job_id, seq, data):
+        """Stores a chunk of a Job's result in its own transaction"""
+        db.session.add(cls(job_id=job_id, seq=seq, data=data))
+        db.session.commit()
+
+    @classmethod
+    def exists(cls, job_id):
+        """Returns True if a Job has stored a result"""
+        return db.session.scalar(select(cls.seq).where(cls.job_id == job_id).limit(1)) is not None
+
+    @classmethod
+    def chunks(cls, job_id):
+        """Yields the chunks of a Job's result in order, reading one at a time"""
+        seq = -1
+        while True:
+            chunk = db.session.execute(
+                select(cls.seq, cls.data).where(cls.job_id == job_id, cls.seq > seq).order_by(cls.seq).limit(1)
+            ).first()
+            if chunk is None:
+                return
+            seq = chunk.seq
+            yield chunk.data
+
+    @classmethod
+    def discard(cls, job_id):
+        """Deletes the result of a Job"""
+        db.session.execute(delete(cls).where(cls.job_id == job_id))
+        db.session.commit()
+
+
 ######################################################################
 #  P E R S I S T E N T   B A S E   M O D E L
 ######################################################################
 class PersistentBase:
     """Base class added persistent methods"""
 
+    # Bumped on every write so cached reads can tell they are stale
+    generation = 0
+    _generation_lock = threading.Lock()
+
+    # Date column counted per day in daily_rollup, None to keep no rollup
+    rollup_column = None
+
     def __init__(self):
         self.id = None  # pylint: disable=invalid-name
 
@@ -36,22 +575,193 @@ class PersistentBase:
         Creates a Account to the database
         """
         logger.info("Creating %s", self.name)
-        self.id = None  # id must be none to generate next primary key
-        db.session.add(self)
-        db.session.commit()
+        # id must be none to generate next primary key, sharded ids come from IdBlock
+        self.id = IdBlock.next_ids(self.__tablename__, 1)[0] if router.sharded else None
+        with router.on(router.shard_for(self.id)), rollback_on_error():
+            db.session.add(self)
+            db.session.flush()  # assigns the id the change is recorded under
+            self.record_change(ChangeLog.UPSERT)
+            RowCount.add(self.__tablename__, 1)
+            self.rollup(self._rollup_days(1))
+            db.session.commit()
+        self.bump_generation()
 
     def update(self):
         """
         Updates a Account to the database
         """
         logger.info("Updating %s", self.name)
-        db.session.commit()
+        with router.on(router.shard_for(self.id)), rollback_on_error():
+            self.record_change(ChangeLog.UPSERT)
+            db.session.commit()
+        self.bump_generation()
 
     def delete(self):
         """Removes a Account from the data store"""
         logger.info("Deleting %s", self.name)
-        db.session.delete(self)
-        db.session.commit()
+        with router.on(router.shard_for(self.id)):
+            self.record_change(ChangeLog.DELETE)
+            RowCount.add(self.__tablename__, -1)
+            self.rollup(self._rollup_days(-1))
+            db.session.delete(self)
+            db.session.commit()
+        self.bump_generation()
+
+    def record_change(self, operation):
+        """Adds the change to the change log in the current transaction"""
+        db.session.add(
+            ChangeLog(resource=self.__tablename__, resource_id=self.id, operation=operation)
+        )
+
+    def _rollup_days(self, delta):
+        """Returns the change a write of this record makes to the daily rollup"""
+        return Counter({getattr(self, self.rollup_column): delta}) if self.rollup_column else Counter()
+
+    def _rollup_days_moved(self, session):
+        """Returns the change to the daily rollup of an unflushed change to the rollup column"""
+        days = Counter()
+        history = inspect(self).attrs[self.rollup_column].history
+        if history.added:
+            old_days = history.deleted
+            if not old_days:  # set while expired, the table still has the old value
+                column = self.__table__.c[self.rollup_column]
+                old_days = [session.scalar(select(column).where(self.__table__.c.id == self.id))]
+            days[old_days[0]] -= 1
+            days[history.added[0]] += 1
+        return days
+
+    @classmethod
+    def rollup(cls, days, session=None):
+        """Adjusts the daily rollup of this table in the current transaction"""
+        if cls.rollup_column:
+            DailyRollup.add(cls.__tablename__, days, session)
+
+    @classmethod
+    def create_many(cls, records):
+        """Creates several records in one transaction per shard"""
+        logger.info("Creating %d %s records", len(records), cls.__tablename__)
+        ids = IdBlock.next_ids(cls.__tablename__, len(records)) if router.sharded else [None] * len(records)
+        by_shard = defaultdict(list)
+        for record, record_id in zip(records, ids):
+            record.id = record_id
+            by_shard[router.shard_for(record_id)].append(record)
+        for shard, shard_records in by_shard.items():
+            with router.on(shard), rollback_on_error():
+                db.session.add_all(shard_records)
+                db.session.flush()
+                days = Counter()
+                for record in shard_records:
+                    record.record_change(ChangeLog.UPSERT)
+                    days += record._rollup_days(1)  # pylint: disable=protected-access
+                RowCount.add(cls.__tablename__, len(shard_records))
+                cls.rollup(days)
+                db.session.commit()
+        cls.bump_generation()
+
+    @classmethod
+    def bulk_update(cls, criteria, values, batch_size, progress=None):
+        """Sets the same values on every record matching some criteria
+
+        Args:
+            criteria (tuple): SQL expressions the records must match
+            values (dict): column names and the values to set
+            batch_size (int): the most records updated per transaction
+            progress (function): called with the records updated so far
+                after every batch, may raise to stop
+
+        Returns:
+            int: the number of records updated
+        """
+        logger.info("Bulk updating %s of %s", ", ".join(values), cls.__tablename__)
+
+        def update_batch(batch):
+            cls._record_changes(select(cls.id).where(*batch).subquery(), ChangeLog.UPSERT)
+            return db.session.execute(cls.__table__.update().where(*batch).values(**values)).rowcount
+
+        return cls._in_batches(criteria, batch_size, update_batch, progress)
+
+    @classmethod
+    def bulk_delete(cls, criteria, batch_size, progress=None):
+        """Deletes every record matching some criteria
+
+        Args:
+            criteria (tuple): SQL expressions the records must match
+            batch_size (int): the most records deleted per transaction
+            progress (function): called with the records deleted so far
+                after every batch, may raise to stop
+
+        Returns:
+            int: the number of records deleted
+        """
+        logger.info("Bulk deleting from %s", cls.__tablename__)
+
+        def delete_batch(batch):
+            cls._record_changes(select(cls.id).where(*batch).subquery(), ChangeLog.DELETE)
+            if cls.rollup_column:
+                column = cls.__table__.c[cls.rollup_column]
+                days = db.session.execute(select(column, db.func.count()).where(*batch).group_by(column))
+                cls.rollup(Counter({day: -count for day, count in days}))
+            deleted = db.session.execute(cls.__table__.delete().where(*batch)).rowcount
+            RowCount.add(cls.__tablename__, -deleted)
+            return deleted
+
+        return cls._in_batches(criteria, batch_size, delete_batch, progress)
+
+    @classmethod
+    def _in_batches(cls, criteria, batch_size, apply, progress=None):
+        """Applies a set-based write to the matching records one id range at a time
+
+        Each batch commits on its own so no lock is held for long. Ranges
+        are walked in id order, so records a batch changes or moves are
+        never visited twice. Shards are visited one after the other.
+
+        Args:
+            criteria (tuple): SQL expressions the records must match
+            batch_size (int): the most records per batch
+            apply (function): runs the write for the criteria of a batch,
+                returns the number of records it affected
+            progress (function): called with the total so far after every batch
+
+        Returns:
+            int: the total number of records affected
+        """
+        affected = 0
+        for shard in router.targets():
+            with router.on(shard), rollback_on_error():
+                after = None
+                while True:
+                    query = select(cls.id).where(*criteria).order_by(cls.id).limit(batch_size)
+                    if after is not None:
+                        query = query.where(cls.id > after)
+                    ids = db.session.scalars(query).all()
+                    if not ids:
+                        break
+                    after = ids[-1]
+                    affected += apply((*criteria, cls.id.between(ids[0], ids[-1])))
+                    db.session.commit()
+                    cls.bump_generation()
+                    if progress:
+                        progress(affected)
+        return affected
+
+    @classmethod
+    def _record_changes(cls, rows, operation):
+        """Logs a change for every row of a subquery with an id column"""
+        result = db.session.execute(
+            ChangeLog.__table__.insert().from_select(
+                ["resource", "resource_id", "operation", "changed_at"],
+                select(literal(cls.__tablename__), rows.c.id, literal(operation), literal(datetime.utcnow())),
+            )
+        )
+        return result.rowcount
+
+    @classmethod
+    def bump_generation(cls):
+        """Marks every cached read of this table as stale"""
+        with PersistentBase._generation_lock:
+            cls.generation += 1
+        with changes_committed:
+            changes_committed.notify_all()
 
     @classmethod
     def init_db(cls, app):
@@ -60,20 +770,224 @@ class PersistentBase:
         cls.app = app
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
+        router.init_app(app, db)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        statement_stats.attach(db.engine)
+        if router.sharded:
+            # DATABASE_URI only keeps what is not sharded
+            db.Model.metadata.create_all(db.engine, tables=[Job.__table__, JobResult.__table__, IdBlock.__table__])
+        for shard in router.shards:
+            with router.on(shard):
+                cls._init_shard(app)
+        if router.sharded:
+            IdBlock.ensure(cls.__tablename__, max(router.gather(cls._max_id)) + 1)
+        cls.build_email_filter()
+
+    @classmethod
+    def _init_shard(cls, app):
+        """Creates the tables of the current shard"""
+        if app.config.get("ACCOUNT_PARTITIONING") and dialect_name() == "postgresql":
+            create_partitioned_tables(app.config["ACCOUNT_PARTITION_START_YEAR"])
+        db.Model.metadata.create_all(db.session.get_bind())  # make our sqlalchemy tables
+        if dialect_name() == "postgresql":
+            create_account_updated_at()
+        RowCount.ensure(cls)
+        create_email_index()
+        if DailyRollup.is_empty(cls.__tablename__) and db.session.scalar(select(cls.id).limit(1)) is not None:
+            cls.rebuild_rollup(only_empty=True)  # accounts created before the rollup existed
+        if dialect_name() == "postgresql":
+            create_change_log_txid()
+            create_search_indexes()
+
+    @classmethod
+    def _max_id(cls):
+        """Returns the highest id used on the current shard, archived records included"""
+        live = db.session.scalar(select(db.func.max(cls.id)))
+        archived = db.session.scalar(select(db.func.max(account_archive.c.id)))
+        return max(live or 0, archived or 0)
 
     @classmethod
     def all(cls):
         """Returns all of the records in the database"""
         logger.info("Processing all records")
-        return cls.query.all()
+        pages = router.gather(lambda: db.session.scalars(select(cls).order_by(cls.id)).all())
+        return list(heapq.merge(*pages, key=lambda record: record.id))
+
+    @classmethod
+    def count(cls, mode, criteria=()):
+        """Counts the records matching some criteria
+
+        Args:
+            mode (string): "exact" runs COUNT(*). "estimate" asks the Postgres
+                planner, which is instant but only as fresh as the last
+                ANALYZE. "cached" reads the counter maintained by every
+                write and only applies without criteria.
+            criteria (tuple): SQL expressions the records must match
+
+        Returns:
+            tuple: the count and the mode that produced it, modes fall back
+            to "exact" where they do not apply
+        """
+        logger.info("Processing %s count", mode)
+        if mode == "cached" and not criteria:
+            totals = router.gather(lambda: RowCount.get(cls.__tablename__))
+            if None not in totals:
+                return sum(totals), mode
+        if mode == "estimate" and dialect_name() == "postgresql":
+            estimates = router.gather(lambda: cls._estimate(criteria))
+            if None not in estimates:
+                return sum(estimates), mode
+        return sum(router.gather(lambda: db.session.scalar(select(db.func.count(cls.id)).where(*criteria)))), "exact"
+
+    @classmethod
+    def _estimate(cls, criteria):
+        """Returns the planner's row estimate for the table or a filtered query
+
+        None when a table that holds rows has never been analyzed, its
+        reltuples of -1 says nothing about how many.
+        """
+        if criteria:
+            statement = select(cls.id).where(*criteria).compile(dialect=db.session.get_bind().dialect)
+            plan = db.session.connection().exec_driver_sql(
+                f"EXPLAIN (FORMAT JSON) {statement}", statement.params
+            ).scalar()
+            return int(plan[0]["Plan"]["Plan Rows"])
+        # a partitioned table has no statistics of its own, its partitions do
+        rows = db.session.execute(
+            text(
+                "SELECT reltuples, pg_relation_size(oid) AS size FROM pg_class "
+                "WHERE relkind = 'r' AND (oid = CAST(:table_name AS regclass) OR oid IN "
+                "(SELECT inhrelid FROM pg_inherits WHERE inhparent = CAST(:table_name AS regclass)))"
+            ),
+            {"table_name": cls.__tablename__},
+        ).all()
+        if any(row.reltuples < 0 and row.size for row in rows):
+            return None
+        return int(sum(max(row.reltuples, 0) for row in rows))
 
     @classmethod
     def find(cls, by_id):
         """Finds a record by it's ID"""
         logger.info("Processing lookup for id %s ...", by_id)
-        return cls.query.get(by_id)
+        with router.on(router.shard_for(by_id)):
+            return db.session.get(cls, by_id)
+
+    @classmethod
+    def find_many(cls, ids):
+        """Finds the records with the given IDs
+
+        Each shard is asked for the IDs it owns, in parallel. Postgres
+        resolves them in a single ``id = ANY(...)`` query, other databases
+        in chunks that fit their bound parameter limit.
+
+        Args:
+            ids (list): the IDs to look up
+
+        Returns:
+            dict: the records found, keyed by ID
+        """
+        logger.info("Processing lookup for %d ids ...", len(ids))
+        by_shard = defaultdict(list)
+        for record_id in ids:
+            by_shard[router.shard_for(record_id)].append(record_id)
+        found = {}
+        for records in router.gather(lambda: cls._find_on_shard(by_shard.get(router.current(), []))):
+            found.update(records)
+        return found
+
+    @classmethod
+    def _find_on_shard(cls, ids):
+        """Finds the records with the given IDs on the current shard"""
+        if not ids:
+            return {}
+        if dialect_name() == "postgresql":
+            criteria = [cls.id_in(ids)]
+        else:
+            criteria = [
+                cls.id.in_(ids[start:start + SQLITE_MAX_IDS_PER_QUERY])
+                for start in range(0, len(ids), SQLITE_MAX_IDS_PER_QUERY)
+            ]
+        found = {}
+        for criterion in criteria:
+            for record in db.session.scalars(select(cls).where(criterion)):
+                found[record.id] = record
+        return found
+
+    @classmethod
+    def id_in(cls, ids):
+        """Returns a criterion matching a list of IDs, a single array parameter on Postgres
+
+        Criteria are built once and run on every shard, so the array is
+        only used when all of them are Postgres.
+        """
+        if dialect_names() == {"postgresql"}:
+            return cls.id == any_(bindparam("ids", list(ids), type_=ARRAY(db.Integer)))
+        return cls.id.in_(ids)
+
+    @classmethod
+    def changes_since(cls, token, limit):
+        """Returns the changes to this table committed after a sync token
+
+        Several changes to one record within a page collapse into the
+        latest, and upserts carry the current state of the record. Tokens
+        belong to one database, sharded they only apply within a shard.
+
+        Args:
+            token (int): the last token the consumer has seen
+            limit (int): the most changes to read
+
+        Returns:
+            tuple: a list of (change, record or None), the next token and
+            whether more changes follow
+        """
+        logger.info("Processing changes since token %s ...", token)
+        changes = (
+            db.session.scalars(
+                select(ChangeLog)
+                .where(ChangeLog.resource == cls.__tablename__, ChangeLog.after(token), *ChangeLog.settled())
+                .order_by(ChangeLog.txid, ChangeLog.id)
+                .limit(limit + 1)
+            ).all()
+        )
+        more = len(changes) > limit
+        changes = changes[:limit]
+        next_token = changes[-1].token if changes else token
+        latest = {change.resource_id: change for change in changes}
+        upserted = [change.resource_id for change in latest.values() if change.operation == ChangeLog.UPSERT]
+        records = cls.find_many(upserted) if upserted else {}
+        feed = []
+        for change in sorted(latest.values(), key=lambda change: change.token):
+            record = records.get(change.resource_id)
+            if change.operation == ChangeLog.UPSERT and record is None:
+                continue  # deleted since, its tombstone is further down the log
+            feed.append((change, record))
+        return feed, next_token, more
+
+
+@event.listens_for(Session, "before_flush")
+def _rollup_moved_days(session, _context, _instances):
+    """Moves a record between days of the rollup when its rollup column is changed"""
+    with session.no_autoflush:
+        for record in session.dirty:
+            if isinstance(record, PersistentBase) and record.rollup_column:
+                record.rollup(record._rollup_days_moved(session), session)  # pylint: disable=protected-access
+
+
+@event.listens_for(Session, "after_bulk_update")
+def _bump_after_bulk_write(context):
+    """Query level updates also invalidate cached reads"""
+    model = context.mapper.class_
+    if issubclass(model, PersistentBase):
+        model.bump_generation()
+
+
+@event.listens_for(Session, "after_bulk_delete")
+def _count_after_bulk_delete(context):
+    """Query level deletes also adjust the row count and invalidate cached reads"""
+    model = context.mapper.class_
+    if issubclass(model, PersistentBase):
+        RowCount.add(model.__tablename__, -context.result.rowcount)
+        model.bump_generation()
 
 
 ######################################################################
@@ -86,6 +1000,32 @@ class Account(db.Model, PersistentBase):
 
     app = None
 
+    # Set once the pg_trgm GIN indexes exist
+    pg_trgm = False
+
+    # Shorter searches have no trigram to look up, only a scan could serve them
+    SEARCH_MIN_LENGTH = 3
+
+    # Fields a bulk update may set, id and date_joined stay as they are
+    BULK_FIELDS = ("name", "email", "address", "phone_number")
+
+    # Filters a bulk operation accepts, every one given must match
+    BULK_FILTERS = ("ids", "name", "email", "address", "joined_after", "joined_before")
+
+    # Signups per day, archived Accounts stay counted
+    rollup_column = "date_joined"
+
+    # Lowercased emails of every Account, a miss proves an email is new
+    # without a query. Built by build_email_filter(), rebuilt larger when
+    # full on a background thread, which then swaps it in
+    email_filter = BloomFilter(1)
+    email_checks = Counter()
+    _email_lock = threading.Lock()
+    _email_build_lock = threading.Lock()
+    _email_builder = None
+    # Emails remembered while a filter is built, None when none is
+    _email_pending = None
+
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64))
@@ -93,6 +1033,9 @@ class Account(db.Model, PersistentBase):
     address = db.Column(db.String(256))
     phone_number = db.Column(db.String(32), nullable=True)  # phone number is optional
     date_joined = db.Column(db.Date(), nullable=False, default=date.today())
+    updated_at = db.Column(
+        db.DateTime(), nullable=False, index=True, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
 
     def __repr__(self):
         return f"<Account {self.name} id=[{self.id}]>"
@@ -105,7 +1048,8 @@ class Account(db.Model, PersistentBase):
             "email": self.email,
             "address": self.address,
             "phone_number": self.phone_number,
-            "date_joined": self.date_joined.isoformat()
+            "date_joined": self.date_joined.isoformat(),
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
         }
 
     def deserialize(self, data):
@@ -118,6 +1062,8 @@ class Account(db.Model, PersistentBase):
         try:
             self.name = data["name"]
             self.email = data["email"]
+            if not isinstance(self.email, str):
+                raise DataValidationError("Invalid Account: email must be a string")
             self.address = data["address"]
             self.phone_number = data.get("phone_number")
             date_joined = data.get("date_joined")
@@ -134,6 +1080,176 @@ class Account(db.Model, PersistentBase):
             ) from error
         return self
 
+    def create(self):
+        """Creates an Account, DuplicateEmailError if its email is taken"""
+        self.check_emails([self.email])
+        with self._email_conflicts(self.email):
+            super().create()
+        self.remember_emails([self.email])
+
+    def update(self):
+        """Updates an Account, DuplicateEmailError if its new email is taken"""
+        if inspect(self).attrs.email.history.added:
+            try:
+                self.check_emails([self.email], exclude_ids=[self.id])
+            except DuplicateEmailError:
+                with router.on(router.shard_for(self.id)):
+                    db.session.rollback()  # drops the rejected change
+                raise
+        with self._email_conflicts(self.email):
+            super().update()
+        self.remember_emails([self.email])
+
+    @classmethod
+    def create_many(cls, records):
+        """Creates several Accounts, DuplicateEmailError if one of their emails is taken"""
+        emails = [record.email for record in records]
+        cls.check_emails(emails)
+        with cls._email_conflicts(", ".join(filter(None, emails))):
+            super().create_many(records)
+        cls.remember_emails(emails)
+
+    @classmethod
+    def bulk_update(cls, criteria, values, batch_size, progress=None):
+        """Sets the same values on every Account matching some criteria
+
+        An email can only be given to a single Account that matches.
+        """
+        if "email" in values:
+            ids = list(heapq.merge(*router.gather(
+                lambda: db.session.scalars(select(cls.id).where(*criteria).order_by(cls.id).limit(2)).all()
+            )))
+            if len(ids) > 1:
+                raise DuplicateEmailError("An email can only be set on one Account")
+            cls.check_emails([values["email"]], exclude_ids=ids)
+        with cls._email_conflicts(values.get("email")):
+            updated = super().bulk_update(criteria, values, batch_size, progress)
+        cls.remember_emails([values.get("email")])
+        return updated
+
+    @classmethod
+    def check_emails(cls, emails, exclude_ids=()):
+        """Raises DuplicateEmailError if an email is given twice or belongs to an Account
+
+        Only the emails the filter may have seen are looked up, across
+        every shard. Emails compare case insensitively.
+
+        Args:
+            emails (list): the emails about to be written
+            exclude_ids (list): Accounts whose own email does not count
+        """
+        keys = [email.lower() for email in emails if email]
+        if len(set(keys)) < len(keys):
+            raise DuplicateEmailError("The same email is given to more than one Account")
+        candidates = [key for key in keys if key in cls.email_filter]
+        with cls._email_lock:
+            cls.email_checks.update(checked=len(keys), looked_up=len(candidates))
+        column = db.func.lower(cls.email)
+        taken = set()
+
+        def find_taken(query):
+            with db.session.no_autoflush:  # the Account being updated is not written yet
+                return db.session.scalars(query).all()
+
+        for start in range(0, len(candidates), SQLITE_MAX_IDS_PER_QUERY):
+            query = select(column).where(column.in_(candidates[start:start + SQLITE_MAX_IDS_PER_QUERY]))
+            if exclude_ids:
+                query = query.where(cls.id.notin_(exclude_ids))
+            for found in router.gather(lambda query=query: find_taken(query)):
+                taken.update(found)
+        if taken:
+            with cls._email_lock:
+                cls.email_checks.update(rejected=1)
+            raise DuplicateEmailError(f"Email {sorted(taken)[0]} is already taken")
+
+    @classmethod
+    def remember_emails(cls, emails):
+        """Adds written emails to the filter, a larger one is built in the background once it is full"""
+        with cls._email_lock:
+            for email in emails:
+                if email:
+                    cls.email_filter.add(email.lower())
+                    if cls._email_pending is not None:
+                        cls._email_pending.append(email.lower())
+            if not cls.email_filter.full() or cls._email_pending is not None:
+                return
+            cls._email_pending = []
+            cls._email_builder = threading.Thread(
+                target=cls._build_email_filter_in_context, name="email-filter", daemon=True
+            )
+            cls._email_builder.start()
+
+    @classmethod
+    def build_email_filter(cls):
+        """Fills a new email filter from the email column of every shard
+
+        The current filter keeps serving while it fills. Emails remembered
+        meanwhile go into both, then the new filter replaces the old one.
+        """
+        with cls._email_build_lock:
+            with cls._email_lock:
+                if cls._email_pending is None:
+                    cls._email_pending = []
+            try:
+                email_filter = cls._fill_email_filter()
+            except Exception:
+                with cls._email_lock:
+                    cls._email_pending = None
+                raise
+            with cls._email_lock:
+                for email in cls._email_pending:
+                    email_filter.add(email)
+                cls.email_filter = email_filter
+                cls._email_pending = None
+            logger.info("Built the email filter of %d emails for %d", len(email_filter), email_filter.capacity)
+
+    @classmethod
+    def _build_email_filter_in_context(cls):
+        with cls.app.app_context():
+            try:
+                cls.build_email_filter()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Could not build a larger email filter")
+            finally:
+                db.session.remove()
+
+    @classmethod
+    def _fill_email_filter(cls):
+        config = cls.app.config
+        capacity = max(2 * cls.count("cached")[0], config["EMAIL_FILTER_MIN_CAPACITY"])
+        email_filter = BloomFilter(capacity, config["EMAIL_FILTER_ERROR_RATE"])
+        query = select(db.func.lower(cls.email)).where(cls.email.isnot(None)).execution_options(yield_per=10000)
+        for shard in router.targets():
+            with router.on(shard):
+                for email in db.session.scalars(query):
+                    email_filter.add(email)
+        return email_filter
+
+    @classmethod
+    def email_filter_stats(cls) -> dict:
+        """Returns the size of the email filter and how many creates it spared a lookup"""
+        with cls._email_lock:
+            checks = dict(cls.email_checks)
+        checked = checks.get("checked", 0)
+        return dict(
+            cls.email_filter.stats(),
+            checked=checked,
+            looked_up=checks.get("looked_up", 0),
+            rejected=checks.get("rejected", 0),
+            skipped_ratio=round(1 - checks.get("looked_up", 0) / checked, 4) if checked else 0.0,
+        )
+
+    @staticmethod
+    @contextmanager
+    def _email_conflicts(email):
+        """Turns a violation of the unique email index into DuplicateEmailError"""
+        try:
+            yield
+        except IntegrityError as error:
+            if EMAIL_INDEX not in str(error.orig):
+                raise
+            raise DuplicateEmailError(f"Email {email} is already taken") from error
+
     @classmethod
     def find_by_name(cls, name):
         """Returns all Accounts with the given name
@@ -142,4 +1258,478 @@ class Account(db.Model, PersistentBase):
             name (string): the name of the Accounts you want to match
         """
         logger.info("Processing name query for %s ...", name)
-        return cls.query.filter(cls.name == name)
+        pages = router.gather(lambda: db.session.scalars(select(cls).where(cls.name == name).order_by(cls.id)).all())
+        return list(heapq.merge(*pages, key=lambda record: record.id))
+
+    @classmethod
+    def search(cls, query, limit, threshold):
+        """Returns the Accounts whose name or address best match a query
+
+        Substring matches rank first, then fuzzy matches by trigram
+        similarity. A query without a word of 3 letters only gets fuzzy
+        matches. Postgres uses the pg_trgm GIN indexes, other databases
+        an in-process trigram index kept in sync with the change log.
+        Sharded, the best matches of every shard are merged.
+
+        Args:
+            query (string): the text to look for
+            limit (int): the most Accounts to return
+            threshold (float): the least similarity of a fuzzy match, 0 to 1
+
+        Returns:
+            list: (Account, score) pairs, best match first
+        """
+        logger.info("Processing search for %s ...", query)
+        if cls.pg_trgm:
+            pages = router.gather(lambda: cls._search_pg_trgm(query, limit, threshold))
+            return heapq.nsmallest(limit, (match for page in pages for match in page),
+                                   key=lambda match: (-match[1], match[0].id))
+        matches = []
+        for shard in router.targets():
+            index = search_indexes[shard]
+            with router.on(shard), index.lock:
+                cls._sync_search_index(index)
+                matches.extend(index.search(query, limit, threshold))
+        matches = heapq.nsmallest(limit, matches, key=lambda match: (-match[1], match[0]))
+        records = cls.find_many([doc_id for doc_id, _ in matches])
+        return [(records[doc_id], score) for doc_id, score in matches if doc_id in records]
+
+    @classmethod
+    def _search_pg_trgm(cls, query, limit, threshold):
+        """Searches with the pg_trgm similarity operator and ILIKE, both served by GIN indexes"""
+        pattern = "%" + re.sub(r"([\\%_])", r"\\\1", query) + "%"
+        substring = db.or_(cls.name.ilike(pattern, escape="\\"), cls.address.ilike(pattern, escape="\\"))
+        if not inner_trigrams(query):
+            substring = db.false()  # the GIN index cannot serve an ILIKE without a trigram
+        score = (
+            db.func.greatest(db.func.similarity(cls.name, query), db.func.similarity(cls.address, query))
+            + db.case((substring, 1), else_=0)
+        ).label("score")
+        # the % operator matches at pg_trgm.similarity_threshold, set for this transaction only
+        db.session.execute(select(db.func.set_config("pg_trgm.similarity_threshold", str(threshold), True)))
+        rows = db.session.execute(
+            select(cls, score)
+            .where(db.or_(substring, cls.name.op("%")(query), cls.address.op("%")(query)))
+            .order_by(score.desc(), cls.id)
+            .limit(limit)
+        ).all()
+        return [(account, round(float(score), 4)) for account, score in rows]
+
+    @classmethod
+    def _sync_search_index(cls, index):
+        """Brings the search index of the current shard up to date with its change log"""
+        if index.token is not None and ChangeLog.is_pruned(cls.__tablename__, index.token):
+            index.clear()  # the changes it missed were pruned
+        if index.token is None:
+            index.token = ChangeLog.latest_token(cls.__tablename__)
+            rows = db.session.execute(select(cls.id, cls.name, cls.address).execution_options(yield_per=1000))
+            for row in rows:
+                index.add(row.id, row.name, row.address)
+            return
+        more = True
+        while more:
+            feed, index.token, more = cls.changes_since(index.token, 1000)
+            for change, record in feed:
+                if record is None:
+                    index.remove(change.resource_id)
+                else:
+                    index.add(record.id, record.name, record.address)
+
+    @classmethod
+    def find_by_date_joined(cls, start=None, end=None):
+        """Returns all Accounts that joined within a date range
+
+        On a partitioned table only the partitions of the range are scanned.
+
+        Args:
+            start (date): earliest date joined, inclusive
+            end (date): latest date joined, exclusive
+        """
+        logger.info("Processing date joined query for %s to %s ...", start, end)
+        pages = router.gather(
+            lambda: db.session.scalars(select(cls).where(*cls.date_joined_between(start, end)).order_by(cls.id)).all()
+        )
+        return list(heapq.merge(*pages, key=lambda record: record.id))
+
+    @classmethod
+    def date_joined_between(cls, start=None, end=None):
+        """Returns the criteria for a range of date joined, either end may be open"""
+        criteria = ()
+        if start:
+            criteria += (cls.date_joined >= start,)
+        if end:
+            criteria += (cls.date_joined < end,)
+        return criteria
+
+    @classmethod
+    def matching(cls, ids=None, name=None, email=None, address=None, joined_after=None, joined_before=None):
+        """Returns the criteria of a bulk operation, every field given must match"""
+        criteria = cls.date_joined_between(joined_after, joined_before)
+        if ids is not None:
+            criteria += (cls.id_in(ids),)
+        for column, value in ((cls.name, name), (cls.email, email), (cls.address, address)):
+            if value is not None:
+                criteria += (column == value,)
+        return criteria
+
+    @classmethod
+    def bulk_filter(cls, filters):
+        """Validates the filter of a bulk operation
+
+        Args:
+            filters (dict): any of BULK_FILTERS, dates as YYYY-MM-DD
+
+        Returns:
+            tuple: the criteria of the Accounts the filter matches
+        """
+        if not isinstance(filters, dict) or not filters:
+            raise DataValidationError("Invalid bulk filter: it must name the accounts to change")
+        unknown = set(filters) - set(cls.BULK_FILTERS)
+        if unknown:
+            raise DataValidationError("Invalid bulk filter: unknown " + ", ".join(sorted(unknown)))
+        empty = [key for key, value in filters.items() if value is None or value == ""]
+        if empty:
+            raise DataValidationError("Invalid bulk filter: empty " + ", ".join(sorted(empty)))
+        ids = filters.get("ids")
+        if ids is not None and not (isinstance(ids, list) and all(isinstance(value, int) for value in ids)):
+            raise DataValidationError("Invalid bulk filter: ids must be a list of integers")
+        if ids is not None and len(ids) > cls.app.config["BATCH_LOOKUP_MAX_IDS"]:
+            raise DataValidationError(f"Invalid bulk filter: at most {cls.app.config['BATCH_LOOKUP_MAX_IDS']} ids")
+        texts = [key for key in ("name", "email", "address") if key in filters and not isinstance(filters[key], str)]
+        if texts:
+            raise DataValidationError("Invalid bulk filter: " + ", ".join(texts) + " must be strings")
+        try:
+            joined_after, joined_before = (
+                date.fromisoformat(filters[key]) if key in filters else None
+                for key in ("joined_after", "joined_before")
+            )
+        except (TypeError, ValueError) as error:
+            raise DataValidationError(f"Invalid bulk filter: {error}") from error
+        criteria = cls.matching(
+            ids=ids,
+            name=filters.get("name"),
+            email=filters.get("email"),
+            address=filters.get("address"),
+            joined_after=joined_after,
+            joined_before=joined_before,
+        )
+        if not criteria:
+            raise DataValidationError("Invalid bulk filter: it must name the accounts to change")
+        return criteria
+
+    @classmethod
+    def bulk_values(cls, data):
+        """Validates the fields a bulk update sets
+
+        Args:
+            data (dict): the fields to set and their new values
+
+        Returns:
+            dict: the values to set, with updated_at refreshed
+        """
+        if not isinstance(data, dict) or not data:
+            raise DataValidationError("Invalid bulk update: set must contain the fields to change")
+        unknown = set(data) - set(cls.BULK_FIELDS)
+        if unknown:
+            raise DataValidationError("Invalid bulk update: cannot set " + ", ".join(sorted(unknown)))
+        for field, value in data.items():
+            if not isinstance(value, str) and (value is not None or field != "phone_number"):
+                raise DataValidationError(f"Invalid bulk update: {field} must be a string")
+        return dict(data, updated_at=datetime.utcnow())
+
+    @classmethod
+    def signups(cls, period, start=None, end=None):
+        """Returns the number of Accounts that joined per day, month or year
+
+        Read from the daily rollup, so archived Accounts are included.
+
+        Args:
+            period (string): "day", "month" or "year"
+            start (date): earliest date joined, inclusive
+            end (date): latest date joined, exclusive
+        """
+        logger.info("Processing signups per %s from %s to %s ...", period, start, end)
+        return DailyRollup.histogram(cls.__tablename__, period, start, end)
+
+    @classmethod
+    def rebuild_rollup(cls, only_empty=False):
+        """Recounts the signups per day from the accounts and the archive"""
+        return DailyRollup.rebuild(
+            cls.__tablename__, cls.rollup_column, [cls.__table__, account_archive], only_empty=only_empty
+        )
+
+    @classmethod
+    def archive(cls, before, batch_size):
+        """Moves the Accounts that joined before a date to account_archive
+
+        Whole yearly partitions are detached and attached to the archive
+        without copying their rows. Everything else is copied and deleted
+        in batches that commit on their own, so no lock is held for long.
+        Archived Accounts leave a tombstone in the change log.
+
+        Args:
+            before (date): Accounts that joined before this date are archived
+            batch_size (int): the most Accounts moved per transaction
+
+        Returns:
+            int: the number of Accounts archived
+        """
+        logger.info("Archiving accounts that joined before %s", before)
+
+        def archive_batch(batch):
+            rows = select(cls.__table__).where(*batch)
+            db.session.execute(
+                account_archive.insert().from_select([column.name for column in cls.__table__.columns], rows)
+            )
+            cls._record_changes(rows.subquery(), ChangeLog.DELETE)
+            deleted = db.session.execute(cls.__table__.delete().where(*batch)).rowcount
+            RowCount.add(cls.__tablename__, -deleted)
+            return deleted
+
+        moved = 0
+        for shard in router.targets():
+            with router.on(shard):
+                if is_partitioned(cls.__tablename__) and is_partitioned(account_archive.name):
+                    moved += cls._archive_partitions(before)
+                # the rest of a partly archived year and the default partition
+                moved += cls._in_batches((cls.date_joined < before,), batch_size, archive_batch)
+        return moved
+
+    @classmethod
+    def _archive_partitions(cls, before):
+        """Moves the yearly partitions that end before a date to the archive
+
+        Detaching a partition locks the whole account table, so it commits
+        on its own right away. A partition detached by an interrupted run
+        is picked up by the next one.
+        """
+        for name in partitions(cls.__tablename__):
+            year = partition_year(name)
+            if year is not None and date(year + 1, 1, 1) <= before:
+                db.session.execute(text(f"ALTER TABLE {cls.__tablename__} DETACH PARTITION {name}"))
+                db.session.commit()
+                cls.bump_generation()
+        attached = set(partitions(cls.__tablename__)) | set(partitions(account_archive.name))
+        db.session.commit()
+        moved = 0
+        for name in inspect(db.session.get_bind()).get_table_names():
+            year = partition_year(name)
+            if year is not None and name not in attached:
+                moved += cls._attach_to_archive(name, year)
+        return moved
+
+    @classmethod
+    def _attach_to_archive(cls, name, year):
+        """Attaches a detached yearly partition to the archive
+
+        Its Accounts are recorded as deleted, and the Accounts of the year
+        archived earlier in batches move into it from the default partition
+        of the archive. A CHECK constraint on the year is then validated
+        without blocking anyone, so attaching does not scan the partition.
+
+        Returns:
+            int: the number of Accounts the partition held
+        """
+        check = f"{name}_date_joined_check"
+        exists = db.session.scalar(
+            text("SELECT 1 FROM pg_constraint WHERE conname = :check AND conrelid = CAST(:name AS regclass)"),
+            {"check": check, "name": name},
+        )
+        count = 0
+        if not exists:
+            columns = [column.name for column in account_archive.columns]
+            partition = db.Table(name, MetaData(), *[db.Column(column) for column in columns])
+            count = cls._record_changes(select(partition.c.id).subquery(), ChangeLog.DELETE)
+            RowCount.add(cls.__tablename__, -count)
+            year_rows = account_archive.c.date_joined.between(date(year, 1, 1), date(year, 12, 31))
+            db.session.execute(partition.insert().from_select(columns, select(account_archive).where(year_rows)))
+            db.session.execute(account_archive.delete().where(year_rows))
+            db.session.execute(text(
+                f"ALTER TABLE {name} ADD CONSTRAINT {check} "
+                f"CHECK (date_joined >= '{year}-01-01' AND date_joined < '{year + 1}-01-01') NOT VALID"
+            ))
+        db.session.commit()
+        cls.bump_generation()
+        db.session.execute(text(f"ALTER TABLE {name} VALIDATE CONSTRAINT {check}"))
+        db.session.commit()
+        db.session.execute(text(
+            f"ALTER TABLE account_archive ATTACH PARTITION {name} "
+            f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+        ))
+        db.session.commit()
+        logger.info("Archived partition %s", name)
+        return count
+
+
+######################################################################
+#  P A R T I T I O N I N G   A N D   A R C H I V A L
+######################################################################
+def copy_columns(table, primary_key=("id",), autoincrement=False):
+    """Returns new columns with the names and types of the columns of a table"""
+    return [
+        db.Column(
+            column.name,
+            column.type,
+            primary_key=column.name in primary_key,
+            autoincrement=autoincrement if column.name == "id" else False,
+            nullable=column.nullable,
+            index=column.index,
+        )
+        for column in table.columns
+    ]
+
+
+# Accounts moved out of the account table by flask db-archive
+account_archive = db.Table("account_archive", *copy_columns(Account.__table__))
+
+
+def create_partitioned_tables(start_year):
+    """Creates account and account_archive partitioned by the year of date_joined
+
+    Postgres requires the partition key in every unique index, so the
+    primary key becomes (id, date_joined) while the ORM keeps using id.
+    Partitions are created up to next year, other dates go to a default
+    partition. Existing tables are left untouched, if either one already
+    exists unpartitioned nothing is partitioned until it is migrated.
+
+    Args:
+        start_year (int): the first year that gets a partition of its own
+    """
+    tables = inspect(db.session.get_bind()).get_table_names()
+    unpartitioned = [
+        name for name in (Account.__tablename__, account_archive.name)
+        if name in tables and not is_partitioned(name)
+    ]
+    db.session.commit()
+    if unpartitioned:
+        logger.warning("ACCOUNT_PARTITIONING is ignored, %s already exist unpartitioned", ", ".join(unpartitioned))
+        return
+    logger.info("Creating tables partitioned by date_joined")
+    with db.session.get_bind().begin() as connection:
+        for table, serial in ((Account.__table__, True), (account_archive, False)):
+            db.Table(
+                table.name,
+                MetaData(),
+                *copy_columns(table, primary_key=("id", "date_joined"), autoincrement=serial),
+                postgresql_partition_by="RANGE (date_joined)",
+            ).create(connection, checkfirst=True)
+            connection.execute(text(f"CREATE TABLE IF NOT EXISTS {table.name}_default PARTITION OF {table.name} DEFAULT"))
+        for year in range(start_year, date.today().year + 2):
+            # a year already moved to the archive keeps its name there and is skipped
+            connection.execute(text(
+                f"CREATE TABLE IF NOT EXISTS account_y{year} PARTITION OF account "
+                f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+            ))
+
+
+def create_email_index():
+    """Creates the unique index on lower(email) that keeps two Accounts from sharing an email
+
+    Each shard only enforces it for its own Accounts. Postgres cannot
+    enforce it on a partitioned table, whose unique indexes must include
+    date_joined, and existing duplicates keep it from being created until
+    they are cleaned up. Creates are still checked against every shard.
+    """
+    if is_partitioned(Account.__tablename__):
+        logger.warning("%s is not created on the partitioned account table", EMAIL_INDEX)
+        return
+    try:
+        with db.session.get_bind().begin() as connection:
+            connection.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS {EMAIL_INDEX} ON account (lower(email))"))
+    except DBAPIError as error:
+        logger.warning("Duplicate emails keep %s from being created: %s", EMAIL_INDEX, error)
+
+
+def create_change_log_txid():
+    """Makes Postgres stamp every change with the id of its transaction
+
+    A change_log created before the txid column existed gets it too, its
+    old changes count as made by transaction 0 and come first in the feed.
+    """
+    default = db.session.scalar(text(
+        "SELECT column_default FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = 'change_log' AND column_name = 'txid'"
+    ))
+    db.session.commit()
+    if default and "txid_current" in default:
+        return
+    with db.session.get_bind().begin() as connection:
+        connection.execute(text("ALTER TABLE change_log ADD COLUMN IF NOT EXISTS txid BIGINT NOT NULL DEFAULT 0"))
+        connection.execute(text("ALTER TABLE change_log ALTER COLUMN txid SET DEFAULT txid_current()"))
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_change_log_resource_txid_id ON change_log (resource, txid, id)"
+        ))
+
+
+def create_account_updated_at():
+    """Adds the updated_at column to account tables created before it existed
+
+    Accounts already there count as updated when the column is added.
+    """
+    missing = db.session.scalars(text(
+        "SELECT t.table_name FROM information_schema.tables t "
+        "WHERE t.table_schema = current_schema() AND t.table_name IN ('account', 'account_archive') "
+        "AND NOT EXISTS (SELECT 1 FROM information_schema.columns c WHERE c.table_schema = t.table_schema "
+        "AND c.table_name = t.table_name AND c.column_name = 'updated_at')"
+    )).all()
+    db.session.commit()
+    if not missing:
+        return
+    with db.session.get_bind().begin() as connection:
+        for table in missing:
+            logger.info("Adding updated_at to %s", table)
+            connection.execute(text(
+                f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT now()"
+            ))
+            connection.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_updated_at ON {table} (updated_at)"))
+
+
+def create_search_indexes():
+    """Creates the pg_trgm GIN indexes behind Account.search
+
+    Without the privilege to install pg_trgm, search falls back to the
+    in-process trigram index.
+    """
+    try:
+        with db.session.get_bind().begin() as connection:
+            connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            for column in ("name", "address"):
+                connection.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS ix_account_{column}_trgm ON account USING gin ({column} gin_trgm_ops)"
+                ))
+        Account.pg_trgm = True
+    except DBAPIError as error:
+        logger.warning("pg_trgm is not available, searching in memory: %s", error)
+
+
+def partitions(table_name):
+    """Returns the names of the partitions of a table"""
+    rows = db.session.execute(
+        text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE parent.relname = :table_name ORDER BY child.relname"
+        ),
+        {"table_name": table_name},
+    )
+    return [row.relname for row in rows]
+
+
+def partition_year(name):
+    """Returns the year of a yearly account partition, None for any other table"""
+    match = re.fullmatch(r"account_y(\d{4})", name)
+    return int(match.group(1)) if match else None
+
+
+def is_partitioned(table_name):
+    """Returns True if the table is a partitioned Postgres table"""
+    if dialect_name() != "postgresql":
+        return False
+    return db.session.execute(
+        text(
+            "SELECT 1 FROM pg_partitioned_table JOIN pg_class ON pg_class.oid = partrelid "
+            "WHERE pg_class.relname = :table_name"
+        ),
+        {"table_name": table_name},
+    ).first() is not None
@@ -4,21 +4,155 @@ Account Service
 This microservice handles the lifecycle of Accounts
 """
 # pylint: disable=unused-import
-from flask import jsonify, request, make_response, abort, url_for   # noqa; F401
-from service.models import Account
+import hmac
+import json
+import os
+import time
+from datetime import date
+from flask import jsonify, request, make_response, abort, url_for, Response, send_file, stream_with_context   # noqa; F401
+from service.models import Account, ChangeLog, DailyRollup, Job, JobResult, changes_committed, db
 from service.common import status  # HTTP Status Codes
-from . import app  # Import Flask application
+from service.common import metrics
+from service.common.cache import ResponseCache
+from service.common.jobs import runner
+from service.common.lifecycle import lifecycle
+from service.common.profiling import HEAP_GROUPS, cpu_profiler, heap_profiler
+from service.common.sharding import router
+from service.common.single_flight import SingleFlight
+from service.common.statement_stats import statement_stats
+from . import app, talisman  # Import Flask application
+
+# Encoded GET /accounts responses keyed by their normalized query string
+list_cache = ResponseCache(
+    max_entries=app.config["LIST_CACHE_MAX_ENTRIES"],
+    max_bytes=app.config["LIST_CACHE_MAX_BYTES"],
+    ttl=app.config["LIST_CACHE_TTL"],
+    gzip_min_bytes=app.config["LIST_CACHE_GZIP_MIN_BYTES"],
+)
+metrics.register("list_cache", list_cache.stats)
+
+COUNT_MODES = ("exact", "estimate", "cached")
+
+# Concurrent identical reads share one query and its serialized result
+reads = SingleFlight()
+metrics.register("single_flight", reads.stats)
+metrics.register("statement_cache", statement_stats.stats)
+metrics.register("cpu_profile", cpu_profiler.stats)
+metrics.register("heap_profile", heap_profiler.stats)
+metrics.register("email_filter", Account.email_filter_stats)
 
 
 ############################################################
 # Health Endpoint
 ############################################################
+# The kubelet probes over plain HTTP, a redirect to HTTPS would fail them
 @app.route("/health")
+@talisman(force_https=False)
 def health():
     """Health Status"""
     return jsonify(dict(status="OK")), status.HTTP_200_OK
 
 
+############################################################
+# Readiness Endpoint
+############################################################
+# 503_SERVICE_UNAVAILABLE while the worker warms up or drains, so
+# Kubernetes only sends traffic to workers that are warm and staying.
+@app.route("/ready")
+@talisman(force_https=False)
+def ready():
+    """Readiness Status"""
+    if not lifecycle.ready():
+        return jsonify(dict(status=lifecycle.state)), status.HTTP_503_SERVICE_UNAVAILABLE
+    return jsonify(dict(status="OK")), status.HTTP_200_OK
+
+
+############################################################
+# Metrics Endpoint
+############################################################
+@app.route("/metrics")
+def get_metrics():
+    """Runtime statistics of the caches and other subsystems"""
+    return jsonify(metrics.snapshot()), status.HTTP_200_OK
+
+
+############################################################
+# Profiling Endpoints
+############################################################
+# Admin only, see ADMIN_TOKEN. Each gunicorn worker profiles itself, the
+# responses carry X-Worker-Pid to tell which one answered.
+#   POST   /admin/profile/cpu?seconds=&interval=  starts sampling stacks
+#   GET    /admin/profile/cpu                     collapsed stacks so far
+#   DELETE /admin/profile/cpu                     stops sampling early
+#   POST   /admin/profile/heap                    starts tracemalloc
+#   GET    /admin/profile/heap?limit=&group_by=lineno|filename|traceback&diff=true
+#   DELETE /admin/profile/heap                    stops tracemalloc
+@app.route("/admin/profile/cpu", methods=["POST"])
+def start_cpu_profile():
+    """Starts a time-boxed sampling CPU profile of this worker"""
+    check_admin()
+    seconds = parse_seconds(request.args.get("seconds"), app.config["PROFILE_DEFAULT_SECONDS"])
+    interval = parse_seconds(request.args.get("interval"), app.config["PROFILE_INTERVAL"])
+    if not cpu_profiler.start(min(seconds, app.config["PROFILE_MAX_SECONDS"]), max(interval, 0.001)):
+        abort(status.HTTP_409_CONFLICT, "A CPU profile is already running")
+    app.logger.info("Started a CPU profile of %s seconds", cpu_profiler.seconds)
+    return admin_response(jsonify(cpu_profiler.stats()), status.HTTP_202_ACCEPTED)
+
+
+@app.route("/admin/profile/cpu", methods=["GET"])
+def get_cpu_profile():
+    """
+    Returns the stacks sampled by the last CPU profile in the collapsed
+    format of flamegraph.pl and speedscope, X-Profile-Status tells
+    whether it is still running
+    """
+    check_admin()
+    if not cpu_profiler.profiles:
+        abort(status.HTTP_404_NOT_FOUND, "No CPU profile was taken")
+    headers = {"X-Profile-Status": "running" if cpu_profiler.running() else "finished"}
+    return admin_response(make_response(cpu_profiler.collapsed(), status.HTTP_200_OK, headers), mimetype="text/plain")
+
+
+@app.route("/admin/profile/cpu", methods=["DELETE"])
+def stop_cpu_profile():
+    """Stops the running CPU profile, keeping its samples"""
+    check_admin()
+    cpu_profiler.stop()
+    return admin_response(make_response("", status.HTTP_204_NO_CONTENT))
+
+
+@app.route("/admin/profile/heap", methods=["POST"])
+def start_heap_profile():
+    """Starts tracing the memory allocations of this worker"""
+    check_admin()
+    if not heap_profiler.start(app.config["TRACEMALLOC_FRAMES"]):
+        abort(status.HTTP_409_CONFLICT, "Heap tracing is already started")
+    app.logger.info("Started heap tracing")
+    return admin_response(jsonify(heap_profiler.stats()), status.HTTP_201_CREATED)
+
+
+@app.route("/admin/profile/heap", methods=["GET"])
+def get_heap_profile():
+    """Returns the largest allocations, or with ?diff=true what grew since tracing started"""
+    check_admin()
+    group_by = request.args.get("group_by", "lineno")
+    if group_by not in HEAP_GROUPS:
+        abort(status.HTTP_400_BAD_REQUEST, f"group_by must be one of {', '.join(HEAP_GROUPS)}")
+    limit = parse_positive_int(request.args.get("limit"), 20)
+    diff = request.args.get("diff", "false").lower() == "true"
+    if not heap_profiler.tracing():
+        abort(status.HTTP_409_CONFLICT, "Heap tracing is not started")
+    return admin_response(jsonify(heap_profiler.top(limit, group_by, diff)))
+
+
+@app.route("/admin/profile/heap", methods=["DELETE"])
+def stop_heap_profile():
+    """Stops tracing memory allocations"""
+    check_admin()
+    heap_profiler.stop()
+    return admin_response(make_response("", status.HTTP_204_NO_CONTENT))
+
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -65,16 +199,284 @@ def create_accounts():
 # return the HTTP_200_OK return code.
 # It should never send back a 404_NOT_FOUND. If you do not find any accounts, send back an
 # empty list ([]) and 200_OK.
+# Pages are served from list_cache until the next write to the table.
+# GET /accounts?ids=1,2,3 resolves a batch of accounts instead, see lookup_accounts.
+# X-Change-Token is the change feed token to sync from after this snapshot,
+# it is not sent when accounts are sharded.
+# ?joined_after=YYYY-MM-DD (inclusive) and ?joined_before=YYYY-MM-DD (exclusive)
+# restrict the list to a range of date_joined.
+# ?count=exact|estimate|cached adds the X-Total-Count header, HEAD /accounts
+# sends only that header (in COUNT_MODE_DEFAULT mode unless ?count is given).
 @app.route("/accounts", methods=["GET"])
 def list_accounts():
+    if "ids" in request.args:
+        return lookup_response(parse_ids(",".join(request.args.getlist("ids")).split(",")))
+    joined_after = parse_date(request.args.get("joined_after"))
+    joined_before = parse_date(request.args.get("joined_before"))
+    criteria = Account.date_joined_between(joined_after, joined_before)
+    count_mode = parse_count_mode(request.args.get("count"), request.method == "HEAD")
+    if request.method == "HEAD":
+        return count_response(count_mode, criteria)
     app.logger.info("Request to list all accounts")
-    accounts = Account.all()
 
-    response_list = []
-    for account in accounts:
-        response_list.append(account.serialize())
+    def build_page():
+        # read before the snapshot so no change after it can be missed
+        headers = {}
+        if not router.sharded:
+            headers["X-Change-Token"] = str(ChangeLog.latest_token(Account.__tablename__))
+        if criteria:
+            accounts = Account.find_by_date_joined(joined_after, joined_before)
+        else:
+            accounts = Account.all()
+
+        response_list = []
+        for account in accounts:
+            response_list.append(account.serialize())
+
+        if count_mode:
+            headers.update(count_headers(count_mode, criteria))
+        return response_list, headers
+
+    return cached_read(normalized_args(), build_page)
+
+
+######################################################################
+# LOOKUP A BATCH OF ACCOUNTS
+######################################################################
+@app.route("/accounts/lookup", methods=["POST"])
+def lookup_accounts():
+    """
+    Reads many Accounts by id in one request
+    The body is {"ids": [...]}, the response lists the accounts found in the
+    order requested and the ids that were missing
+    """
+    check_content_type("application/json")
+    data = request.get_json()
+    if not isinstance(data, dict) or not isinstance(data.get("ids"), list):
+        abort(status.HTTP_400_BAD_REQUEST, "Body must contain a list of ids")
+    return lookup_response(parse_ids(data["ids"]))
+
+
+######################################################################
+# BULK UPDATE AND DELETE ACCOUNTS
+######################################################################
+# The body names the accounts in "filter": any of Account.BULK_FILTERS, that
+# is ids (a list), name, email, address, joined_after and joined_before.
+# PATCH also takes the fields to change in "set". Both run in batches of
+# BULK_BATCH_SIZE accounts that commit on their own, so a failure can
+# leave earlier batches applied. "dry_run": true only counts the matches.
+@app.route("/accounts", methods=["PATCH"])
+def bulk_update_accounts():
+    """Sets the same fields on every Account matching a filter"""
+    check_content_type("application/json")
+    data = request.get_json()
+    criteria = bulk_criteria(data)
+    values = Account.bulk_values(data.get("set"))
+    app.logger.info("Request to bulk update accounts")
+    if data.get("dry_run"):
+        return bulk_response(Account.count("exact", criteria)[0], True)
+    return bulk_response(Account.bulk_update(criteria, values, app.config["BULK_BATCH_SIZE"]), False)
+
+
+@app.route("/accounts", methods=["DELETE"])
+def bulk_delete_accounts():
+    """Deletes every Account matching a filter"""
+    check_content_type("application/json")
+    data = request.get_json()
+    criteria = bulk_criteria(data)
+    app.logger.info("Request to bulk delete accounts")
+    if data.get("dry_run"):
+        return bulk_response(Account.count("exact", criteria)[0], True)
+    return bulk_response(Account.bulk_delete(criteria, app.config["BULK_BATCH_SIZE"]), False)
+
+
+######################################################################
+# BACKGROUND JOBS
+######################################################################
+# POST /jobs {"kind": ..., "params": {...}} queues one of the job kinds
+# registered in service.common.jobs:
+#   export                           writes every account to a JSON lines file
+#   import       {"accounts": [...]} creates the accounts
+#   bulk_update  {"filter", "set"}   like PATCH /accounts
+#   bulk_delete  {"filter"}          like DELETE /accounts
+# and answers 202_ACCEPTED with the job to poll at GET /jobs/<id>.
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    """Queues a long-running operation"""
+    check_content_type("application/json")
+    data = request.get_json()
+    if not isinstance(data, dict) or data.get("kind") not in runner.handlers:
+        abort(status.HTTP_400_BAD_REQUEST, f"kind must be one of {', '.join(sorted(runner.handlers))}")
+    params = data.get("params", {})
+    if not isinstance(params, dict):
+        abort(status.HTTP_400_BAD_REQUEST, "params must be an object")
+    if not runner.has_capacity():
+        abort(
+            status.HTTP_503_SERVICE_UNAVAILABLE,
+            "Too many jobs are queued or running",
+            retry_after=app.config["SHED_RETRY_AFTER"],
+        )
+    app.logger.info("Request to submit a %s job", data["kind"])
+    job = runner.submit(data["kind"], params)
+    location_url = url_for("get_job", job_id=job.id, _external=True)
+    return make_response(jsonify(job.serialize()), status.HTTP_202_ACCEPTED, {"Location": location_url})
+
+
+@app.route("/jobs/<int:job_id>", methods=["GET"])
+def get_job(job_id):
+    """Reports the status, progress and result of a job"""
+    app.logger.info("Request to read job %s", job_id)
+    return jsonify(find_job(job_id).serialize()), status.HTTP_200_OK
+
 
-    return make_response(jsonify(response_list), status.HTTP_200_OK)
+@app.route("/jobs/<int:job_id>", methods=["DELETE"])
+def cancel_job(job_id):
+    """
+    Cancels a job
+    A queued job never starts, a running one stops after its current
+    batch, keeping the batches it already committed
+    """
+    app.logger.info("Request to cancel job %s", job_id)
+    job = find_job(job_id)
+    if job.status in Job.FINISHED:
+        abort(status.HTTP_409_CONFLICT, f"Job {job_id} is already {job.status}")
+    runner.cancel(job)
+    return jsonify(job.serialize()), status.HTTP_202_ACCEPTED
+
+
+@app.route("/jobs/<int:job_id>/result", methods=["GET"])
+def get_job_result(job_id):
+    """Downloads the file stored by an export job, from any replica"""
+    job = find_job(job_id)
+    if job.status != Job.SUCCEEDED or not JobResult.exists(job_id):
+        abort(status.HTTP_404_NOT_FOUND, f"Job {job_id} has no result file")
+    return Response(
+        stream_with_context(JobResult.chunks(job_id)),
+        mimetype="application/x-ndjson",
+        headers={"Content-Disposition": f"attachment; filename=accounts-{job_id}.jsonl"},
+    )
+
+
+######################################################################
+# SEARCH ACCOUNTS
+######################################################################
+@app.route("/accounts/search", methods=["GET"])
+def search_accounts():
+    """
+    Finds Accounts whose name or address contains or resembles ?q=
+    ?limit= caps the number of results and ?threshold= (0 to 1) is the
+    least trigram similarity of a fuzzy match. Results come best first.
+    """
+    query = request.args.get("q", "").strip()
+    if len(query) < Account.SEARCH_MIN_LENGTH:
+        abort(status.HTTP_400_BAD_REQUEST, f"A search needs a q of at least {Account.SEARCH_MIN_LENGTH} characters")
+    try:
+        limit = int(request.args.get("limit", app.config["SEARCH_DEFAULT_LIMIT"]))
+        threshold = float(request.args.get("threshold", app.config["SEARCH_DEFAULT_THRESHOLD"]))
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "limit must be an integer and threshold a number")
+    if not 1 <= limit <= app.config["SEARCH_MAX_LIMIT"] or not 0 < threshold <= 1:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"limit must be between 1 and {app.config['SEARCH_MAX_LIMIT']} and threshold above 0 and at most 1",
+        )
+    app.logger.info("Request to search accounts for %s", query)
+
+    def build_results():
+        matches = Account.search(query, limit, threshold)
+        return [{"score": score, "account": account.serialize()} for account, score in matches], {}
+
+    return cached_read(normalized_args(), build_results)
+
+
+######################################################################
+# SIGNUP STATISTICS
+######################################################################
+@app.route("/accounts/stats", methods=["GET"])
+def account_stats():
+    """
+    Counts the Accounts that joined per ?period=day|month|year (default
+    month), optionally between ?joined_after= (inclusive) and
+    ?joined_before= (exclusive). Read from the daily rollup, so archived
+    Accounts are counted and no account is scanned.
+    """
+    period = request.args.get("period", "month")
+    if period not in DailyRollup.PERIODS:
+        abort(status.HTTP_400_BAD_REQUEST, f"period must be one of {', '.join(DailyRollup.PERIODS)}")
+    joined_after = parse_date(request.args.get("joined_after"))
+    joined_before = parse_date(request.args.get("joined_before"))
+    app.logger.info("Request for signups per %s", period)
+
+    def build_stats():
+        signups = Account.signups(period, joined_after, joined_before)
+        return {
+            "period": period,
+            "total": sum(count for _, count in signups),
+            "signups": [{"period": label, "count": count} for label, count in signups],
+        }, {}
+
+    return cached_read(normalized_args(), build_stats)
+
+
+######################################################################
+# CHANGE FEED
+######################################################################
+@app.route("/accounts/changes", methods=["GET"])
+def list_account_changes():
+    """
+    Returns the changes committed after the ?since=<token> sync token
+    Consumers start from the X-Change-Token of GET /accounts and pass the
+    returned "next" token on the following call. Tokens are sent as strings,
+    they outgrow the integers a JSON number holds exactly
+    """
+    since = parse_token(request.args.get("since", "0"))
+    limit = parse_limit(request.args.get("limit"))
+    app.logger.info("Request for account changes since %s", since)
+    feed, next_token, more = Account.changes_since(since, limit)
+    return make_response(
+        jsonify(changes=[change_event(change, account) for change, account in feed], next=str(next_token), more=more),
+        status.HTTP_200_OK,
+    )
+
+
+@app.route("/accounts/changes/stream", methods=["GET"])
+def stream_account_changes():
+    """
+    Pushes account changes as Server-Sent Events as they are committed
+    The stream ends after CHANGE_STREAM_MAX_SECONDS, clients reconnect with
+    the Last-Event-ID header to resume. Each open stream occupies a worker
+    thread, so run gunicorn with threads when streams are used.
+    """
+    since = parse_token(request.headers.get("Last-Event-ID") or request.args.get("since", "0"))
+    app.logger.info("Request to stream account changes since %s", since)
+    deadline = time.monotonic() + app.config["CHANGE_STREAM_MAX_SECONDS"]
+    poll_seconds = app.config["CHANGE_STREAM_POLL_SECONDS"]
+    limit = app.config["CHANGE_FEED_PAGE_SIZE"]
+
+    def events():
+        token = since
+        yield f"retry: {int(poll_seconds * 1000)}\n\n"
+        while time.monotonic() < deadline:
+            generation = Account.generation
+            feed, token, more = Account.changes_since(token, limit)
+            db.session.remove()  # don't sit in a transaction between polls
+            for change, account in feed:
+                yield f"id: {change.token}\nevent: {change.operation}\ndata: {json.dumps(change_event(change, account))}\n\n"
+            if more:
+                continue
+            with changes_committed:
+                woken = changes_committed.wait_for(
+                    lambda: Account.generation != generation,
+                    min(poll_seconds, max(deadline - time.monotonic(), 0)),
+                )
+            if not woken:
+                yield ": keepalive\n\n"
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 ######################################################################
@@ -88,11 +490,13 @@ def list_accounts():
 @app.route("/account/<account_id>", methods=["GET"])
 def read_account_id(account_id):
     app.logger.info("Request to read an Account with id: %s", account_id)
-    account = Account.find(account_id)
-    if not account:
+    message = reads.do(
+        ("account", account_id, Account.generation), lambda: serialized_account(account_id)
+    )
+    if not message:
         return make_response(jsonify(""), status.HTTP_404_NOT_FOUND)
 
-    return make_response(jsonify(account.serialize()), status.HTTP_200_OK)
+    return make_response(jsonify(message), status.HTTP_200_OK)
 
 
 ######################################################################
@@ -111,7 +515,6 @@ def update_account(account_id):
     if not account:
         return make_response(jsonify(""), status.HTTP_404_NOT_FOUND)
 
-    account = Account()
     account.deserialize(request.get_json())
     account.update()
     return make_response(jsonify(account.serialize()), status.HTTP_200_OK)
@@ -149,3 +552,214 @@ def check_content_type(media_type):
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
         f"Content-Type must be {media_type}",
     )
+
+
+def lookup_response(ids):
+    """Returns the accounts with the given ids and the ids that are missing"""
+    app.logger.info("Request to lookup %d accounts", len(ids))
+
+    def build_lookup():
+        found = Account.find_many(ids)
+        return {
+            "accounts": [found[account_id].serialize() for account_id in ids if account_id in found],
+            "missing": [account_id for account_id in ids if account_id not in found],
+        }, {}
+
+    return cached_read(("lookup", tuple(ids)), build_lookup)
+
+
+def parse_ids(values):
+    """Returns the distinct account ids in values, in the order given"""
+    try:
+        ids = list(dict.fromkeys(int(value) for value in values if str(value).strip()))
+    except (TypeError, ValueError):
+        abort(status.HTTP_400_BAD_REQUEST, "Account ids must be integers")
+    if len(ids) > app.config["BATCH_LOOKUP_MAX_IDS"]:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"At most {app.config['BATCH_LOOKUP_MAX_IDS']} ids can be looked up at once",
+        )
+    return ids
+
+
+def bulk_criteria(data):
+    """Returns the criteria of the filter of a bulk request"""
+    if not isinstance(data, dict):
+        abort(status.HTTP_400_BAD_REQUEST, "A bulk request must contain a filter")
+    return Account.bulk_filter(data.get("filter"))
+
+
+def find_job(job_id):
+    """Returns a Job or aborts with 404_NOT_FOUND"""
+    job = Job.find(job_id)
+    if not job:
+        abort(status.HTTP_404_NOT_FOUND, f"Job with id [{job_id}] could not be found.")
+    return job
+
+
+def bulk_response(affected, dry_run):
+    """Reports the number of accounts a bulk request matched or changed"""
+    return make_response(jsonify(affected=affected, dry_run=dry_run), status.HTTP_200_OK)
+
+
+def cached_read(key, build):
+    """Serves a read from list_cache, building it at most once per generation
+
+    Args:
+        key: identifies the read in list_cache
+        build (function): returns the data to send as JSON and the response headers
+    """
+    generation = Account.generation
+    entry = list_cache.get(key, generation)
+    if entry is not None:
+        return cached_response(key, entry, "HIT")
+
+    def build_entry():
+        data, headers = build()
+        return list_cache.put(key, generation, jsonify(data).get_data(), headers)
+
+    entry = reads.do(("list", key, generation), build_entry)
+    return cached_response(key, entry, "MISS")
+
+
+def count_response(count_mode, criteria):
+    """Answers HEAD /accounts with the X-Total-Count header, cached until the next write"""
+    app.logger.info("Request to count accounts")
+    key = ("HEAD",) + normalized_args()
+    generation = Account.generation
+    entry = list_cache.get(key, generation)
+    if entry is not None:
+        return cached_response(key, entry, "HIT")
+    entry = list_cache.put(key, generation, b"", count_headers(count_mode, criteria))
+    return cached_response(key, entry, "MISS")
+
+
+def count_headers(count_mode, criteria):
+    """Returns the X-Total-Count header and the mode that produced it"""
+    total, mode = Account.count(count_mode, criteria)
+    return {"X-Total-Count": str(total), "X-Count-Mode": mode}
+
+
+def parse_count_mode(value, required):
+    """Returns the count mode requested, the default one if required"""
+    if not value:
+        return app.config["COUNT_MODE_DEFAULT"] if required else None
+    if value not in COUNT_MODES:
+        abort(status.HTTP_400_BAD_REQUEST, f"count must be one of {', '.join(COUNT_MODES)}")
+    return value
+
+
+def parse_date(value):
+    """Returns the date of an ISO 8601 YYYY-MM-DD query parameter, if given"""
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        abort(status.HTTP_400_BAD_REQUEST, f"Invalid date: {value}")
+
+
+def parse_token(value):
+    """Returns a change feed token, 410_GONE if its changes were pruned"""
+    if router.sharded:
+        # every shard numbers its own changes, one token cannot resume them all
+        abort(status.HTTP_501_NOT_IMPLEMENTED, "The change feed is not available when accounts are sharded")
+    try:
+        token = int(value)
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "The change token must be an integer")
+    if not 0 <= token <= ChangeLog.MAX_TOKEN:
+        abort(status.HTTP_400_BAD_REQUEST, "The change token is out of range")
+    if ChangeLog.is_pruned(Account.__tablename__, token):
+        abort(status.HTTP_410_GONE, "Changes since this token were pruned, resync from GET /accounts")
+    return token
+
+
+def parse_seconds(value, default):
+    """Returns a positive duration in seconds"""
+    if not value:
+        return default
+    try:
+        seconds = float(value)
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "Durations must be numbers of seconds")
+    if seconds <= 0:
+        abort(status.HTTP_400_BAD_REQUEST, "Durations must be positive")
+    return seconds
+
+
+def parse_positive_int(value, default):
+    """Returns a positive integer query parameter"""
+    if not value:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, f"{value} is not an integer")
+    if number < 1:
+        abort(status.HTTP_400_BAD_REQUEST, f"{value} is not positive")
+    return number
+
+
+def check_admin():
+    """Answers 404 when admin endpoints are disabled, 401 without the admin token"""
+    token = app.config["ADMIN_TOKEN"]
+    if not token:
+        abort(status.HTTP_404_NOT_FOUND, "Admin endpoints are disabled")
+    scheme, _, given = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(given.encode(), token.encode()):
+        abort(status.HTTP_401_UNAUTHORIZED, "A valid admin token is required")
+
+
+def admin_response(response, code=None, mimetype=None):
+    """Marks an admin response with the worker that produced it and keeps it out of caches"""
+    if code is not None:
+        response.status_code = code
+    if mimetype is not None:
+        response.mimetype = mimetype
+    response.headers["X-Worker-Pid"] = str(os.getpid())
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+def parse_limit(value):
+    """Returns the page size requested, bounded by CHANGE_FEED_PAGE_SIZE"""
+    page_size = app.config["CHANGE_FEED_PAGE_SIZE"]
+    try:
+        return min(max(int(value), 1), page_size) if value else page_size
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "The limit must be an integer")
+
+
+def change_event(change, account):
+    """Serializes a change feed entry"""
+    return {
+        "token": str(change.token),
+        "operation": change.operation,
+        "id": change.resource_id,
+        "account": account.serialize() if account else None,
+    }
+
+
+def normalized_args():
+    """Returns the path and query parameters as a hashable key independent of their order"""
+    return (request.path,) + tuple(sorted((name, tuple(values)) for name, values in request.args.lists()))
+
+
+def serialized_account(account_id):
+    """Returns the serialized Account or None if it does not exist"""
+    account = Account.find(account_id)
+    return account.serialize() if account else None
+
+
+def cached_response(key, entry, cache_status):
+    """Builds a response from a cache entry, gzipped if the client accepts it"""
+    headers = {"Content-Type": "application/json", "X-Cache": cache_status, "Vary": "Accept-Encoding"}
+    headers.update(entry.headers)
+    body = entry.body
+    if "gzip" in request.accept_encodings:
+        gzipped = list_cache.gzipped(key, entry)
+        if gzipped is not None:
+            body = gzipped
+            headers["Content-Encoding"] = "gzip"
+    return make_response(body, status.HTTP_200_OK, headers)
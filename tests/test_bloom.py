@@ -0,0 +1,53 @@
+"""
+Bloom Filter Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+from unittest import TestCase
+from service.common.bloom import BloomFilter
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestBloomFilter(TestCase):
+    """Bloom Filter Tests"""
+
+    def test_no_false_negatives(self):
+        """It should find every key it was given"""
+        bloom = BloomFilter(1000)
+        keys = [f"user{number}@example.com" for number in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+        self.assertEqual(len(bloom), 1000)
+
+    def test_false_positive_rate(self):
+        """It should rarely claim a key it was not given"""
+        bloom = BloomFilter(2000, error_rate=0.01)
+        for number in range(2000):
+            bloom.add(f"user{number}@example.com")
+        false_positives = sum(f"other{number}@example.com" in bloom for number in range(10000))
+        self.assertLess(false_positives, 300)
+        self.assertAlmostEqual(bloom.false_positive_rate(), 0.01, delta=0.005)
+
+    def test_full(self):
+        """It should report when it holds more keys than it was sized for"""
+        bloom = BloomFilter(2)
+        self.assertNotIn("a", bloom)
+        bloom.add("a")
+        bloom.add("b")
+        self.assertFalse(bloom.full())
+        bloom.add("c")
+        self.assertTrue(bloom.full())
+
+    def test_stats(self):
+        """It should report its size"""
+        bloom = BloomFilter(100, error_rate=0.01)
+        bloom.add("a")
+        stats = bloom.stats()
+        self.assertEqual((stats["capacity"], stats["keys"], stats["hashes"]), (100, 1, 7))
+        self.assertEqual(stats["bytes"], 120)
+        self.assertLess(stats["false_positive_rate"], 0.001)
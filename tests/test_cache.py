@@ -0,0 +1,72 @@
+"""
+Response Cache Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import gzip
+from unittest import TestCase
+from unittest.mock import patch
+from service.common.cache import ResponseCache
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestResponseCache(TestCase):
+    """Response Cache Tests"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.cache = ResponseCache(max_entries=3, max_bytes=100, gzip_min_bytes=10)
+
+    def test_hit_and_miss(self):
+        """It should return an entry only for the generation it was built from"""
+        self.assertIsNone(self.cache.get("a", 1))
+        self.cache.put("a", 1, b"[]")
+        self.assertEqual(self.cache.get("a", 1).body, b"[]")
+        self.assertIsNone(self.cache.get("a", 2))
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["entries"], 0)
+
+    def test_evict_by_count(self):
+        """It should evict the least recently used entry when full"""
+        for key in "abc":
+            self.cache.put(key, 1, b"x")
+        self.cache.get("a", 1)
+        self.cache.put("d", 1, b"x")
+        self.assertIsNone(self.cache.get("b", 1))
+        self.assertIsNotNone(self.cache.get("a", 1))
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_evict_by_bytes(self):
+        """It should keep the cache under its byte budget"""
+        self.cache.put("a", 1, b"x" * 60)
+        self.cache.put("b", 1, b"x" * 60)
+        self.assertIsNone(self.cache.get("a", 1))
+        self.assertEqual(self.cache.stats()["bytes"], 60)
+        self.cache.put("c", 1, b"x" * 200)
+        self.assertIsNone(self.cache.get("c", 1))
+
+    def test_ttl(self):
+        """It should expire entries older than the ttl"""
+        self.cache.ttl = 5
+        with patch("service.common.cache.time.monotonic", return_value=100.0):
+            self.cache.put("a", 1, b"[]")
+        with patch("service.common.cache.time.monotonic", return_value=104.0):
+            self.assertIsNotNone(self.cache.get("a", 1))
+        with patch("service.common.cache.time.monotonic", return_value=106.0):
+            self.assertIsNone(self.cache.get("a", 1))
+
+    def test_gzipped(self):
+        """It should compress a body once and only when it is large enough"""
+        small = self.cache.put("a", 1, b"[]")
+        self.assertIsNone(self.cache.gzipped("a", small))
+        large = self.cache.put("b", 1, b"[" + b"1," * 20 + b"1]")
+        compressed = self.cache.gzipped("b", large)
+        self.assertEqual(gzip.decompress(compressed), large.body)
+        self.assertIs(self.cache.gzipped("b", large), compressed)
+        self.assertEqual(self.cache.stats()["bytes"], len(small.body) + large.size)
@@ -2,10 +2,11 @@
 CLI Command Extensions for Flask
 """
 import os
+from datetime import date
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
-from service.common.cli_commands import db_create
+from service.common.cli_commands import db_create, db_archive, changes_prune, rollup_rebuild
 
 
 class TestFlaskCLI(TestCase):
@@ -21,3 +22,33 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    @patch('service.common.cli_commands.ChangeLog')
+    def test_changes_prune(self, change_log_mock):
+        """It should call the changes-prune command"""
+        change_log_mock.prune.return_value = 3
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(changes_prune, ["--days", "7"])
+            self.assertEqual(result.exit_code, 0)
+        self.assertIn("Pruned 3 changes", result.output)
+        change_log_mock.prune.assert_called_once()
+
+    @patch('service.common.cli_commands.Account')
+    def test_db_archive(self, account_mock):
+        """It should call the db-archive command"""
+        account_mock.archive.return_value = 5
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_archive, ["--before", "2015-01-01", "--batch-size", "10"])
+            self.assertEqual(result.exit_code, 0)
+        self.assertIn("Archived 5 accounts", result.output)
+        account_mock.archive.assert_called_once_with(date(2015, 1, 1), 10)
+
+    @patch('service.common.cli_commands.Account')
+    def test_rollup_rebuild(self, account_mock):
+        """It should call the rollup-rebuild command"""
+        account_mock.rebuild_rollup.return_value = 7
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(rollup_rebuild)
+            self.assertEqual(result.exit_code, 0)
+        self.assertIn("Counted 7 signups", result.output)
+        account_mock.rebuild_rollup.assert_called_once_with()
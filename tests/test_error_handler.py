@@ -42,7 +42,7 @@ class TestErrorHandler(TestCase):
 
     def test_method_not_allowed(self):
         """It should not allow an illegal method call"""
-        resp = self.client.delete(ACCOUNTS_BASE_URL)
+        resp = self.client.put(ACCOUNTS_BASE_URL)
         self.assertEqual(resp.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
 
     def test_method_not_found(self):
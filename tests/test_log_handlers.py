@@ -0,0 +1,94 @@
+"""
+Log Handlers Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import json
+import logging
+import queue
+from unittest import TestCase
+from flask import Flask
+from service.common.log_handlers import (
+    ContextQueueHandler, JsonFormatter, SamplingFilter, init_logging, parse_sampling, stop_listener
+)
+
+
+class ListHandler(logging.Handler):
+    """Collects formatted records"""
+
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+def make_record(msg="Processing lookup for id %s ...", args=(1,), level=logging.INFO, **extra):
+    """Builds a log record like logger.info() would"""
+    record = logging.LogRecord("flask.app", level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLogHandlers(TestCase):
+    """Log Handler Tests"""
+
+    def test_json_formatter(self):
+        """It should format a record as one JSON object with its request fields"""
+        line = JsonFormatter().format(make_record(request_id="abc", duration_ms=1.5))
+        entry = json.loads(line)
+        self.assertEqual(entry["message"], "Processing lookup for id 1 ...")
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual(entry["request_id"], "abc")
+        self.assertEqual(entry["duration_ms"], 1.5)
+        self.assertNotIn("status", entry)
+
+    def test_sampling_filter(self):
+        """It should keep one in N info lines per template and every warning"""
+        sampler = SamplingFilter(0.25)
+        kept = [sampler.filter(make_record()) for _ in range(8)]
+        self.assertEqual(kept.count(True), 2)
+        self.assertTrue(sampler.filter(make_record("Rare line", ())))
+        self.assertTrue(sampler.filter(make_record(level=logging.WARNING)))
+        self.assertFalse(SamplingFilter(0).filter(make_record()))
+
+    def test_parse_sampling(self):
+        """It should parse per logger sampling rates"""
+        self.assertEqual(parse_sampling("flask.app=0.1, gunicorn.access=0.5"),
+                         {"flask.app": 0.1, "gunicorn.access": 0.5})
+
+    def test_queue_handler_defers_formatting(self):
+        """It should queue records without formatting them"""
+        log_queue = queue.SimpleQueue()
+        record = make_record()
+        ContextQueueHandler(log_queue).handle(record)
+        self.assertIs(log_queue.get_nowait(), record)
+        self.assertFalse(hasattr(record, "message"))
+
+    def test_init_logging(self):
+        """It should log every request as JSON with its id and duration"""
+        handler = ListHandler()
+        upstream = logging.getLogger("test.upstream")
+        upstream.handlers = [handler]
+        upstream.setLevel(logging.INFO)
+        app = Flask("test_logging")
+        app.config["LOG_SAMPLING"] = "test.sampled=0.5"
+        app.add_url_rule("/", "index", lambda: "OK")
+        init_logging(app, "test.upstream")
+        self.assertIsInstance(app.logger.handlers[0], ContextQueueHandler)
+        self.assertEqual(len(logging.getLogger("test.sampled").filters), 1)
+
+        response = app.test_client().get("/", headers={"X-Request-ID": "req-1"})
+        self.assertEqual(response.headers["X-Request-ID"], "req-1")
+        stop_listener(app.extensions["log_listener"])  # drains the queue
+        entries = [json.loads(line) for line in handler.lines]
+        finished = [entry for entry in entries if entry.get("request_id") == "req-1"]
+        self.assertEqual(len(finished), 1)
+        self.assertEqual(finished[0]["status"], 200)
+        self.assertIn("duration_ms", finished[0])
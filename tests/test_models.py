@@ -3,10 +3,17 @@ Test cases for Account Model
 
 """
 import logging
+import threading
 import unittest
 import os
+from unittest.mock import patch
 from service import app
-from service.models import Account, DataValidationError, db
+from datetime import date, datetime, timedelta
+from service.common.bloom import BloomFilter
+from sqlalchemy import text
+from service.models import (
+    Account, ChangeLog, DataValidationError, DuplicateEmailError, RowCount, account_archive, db
+)
 from tests.factories import AccountFactory
 
 DATABASE_URI = os.getenv(
@@ -36,6 +43,7 @@ class TestAccount(unittest.TestCase):
     def setUp(self):
         """This runs before each test"""
         db.session.query(Account).delete()  # clean up the last tests
+        db.session.execute(account_archive.delete())
         db.session.commit()
 
     def tearDown(self):
@@ -142,6 +150,285 @@ class TestAccount(unittest.TestCase):
         self.assertEqual(same_account.id, account.id)
         self.assertEqual(same_account.name, account.name)
 
+    def test_find_many(self):
+        """It should Find many Accounts by id in any chunk size"""
+        accounts = AccountFactory.create_batch(5)
+        for account in accounts:
+            account.create()
+        ids = [account.id for account in accounts] + [0]
+        found = Account.find_many(ids)
+        self.assertEqual(sorted(found), sorted(ids[:-1]))
+        with patch("service.models.SQLITE_MAX_IDS_PER_QUERY", 2):
+            self.assertEqual(Account.find_many(ids).keys(), found.keys())
+
+    def test_changes_since(self):
+        """It should log every write and replay the latest change per Account"""
+        token = ChangeLog.latest_token(Account.__tablename__)
+        kept, removed = AccountFactory.create_batch(2)
+        kept.create()
+        removed.create()
+        kept.email = "changed@example.com"
+        kept.update()
+        removed_id = removed.id
+        removed.delete()
+
+        feed, next_token, more = Account.changes_since(token, 100)
+        self.assertFalse(more)
+        self.assertEqual(next_token, ChangeLog.latest_token(Account.__tablename__))
+        self.assertEqual(
+            [(change.operation, change.resource_id) for change, _ in feed],
+            [(ChangeLog.UPSERT, kept.id), (ChangeLog.DELETE, removed_id)],
+        )
+        self.assertEqual(feed[0][1].email, "changed@example.com")
+        self.assertIsNone(feed[1][1])
+        self.assertIsNotNone(feed[0][1].updated_at)
+
+        feed, next_token, more = Account.changes_since(token, 1)
+        self.assertTrue(more)
+        self.assertEqual(len(feed), 1)
+        self.assertEqual(next_token, feed[0][0].token)
+        self.assertGreater(next_token, token)
+
+    def test_changes_in_transaction_order(self):
+        """It should replay changes in the order of their transactions, not of their ids"""
+        first, second = AccountFactory.create_batch(2)
+        first.create()
+        second.create()
+        db.session.query(ChangeLog).delete()
+        db.session.add_all([
+            ChangeLog(txid=2, resource=Account.__tablename__, resource_id=first.id, operation=ChangeLog.UPSERT),
+            ChangeLog(txid=1, resource=Account.__tablename__, resource_id=second.id, operation=ChangeLog.UPSERT),
+        ])
+        db.session.commit()
+        self.addCleanup(lambda: (db.session.query(ChangeLog).delete(), db.session.commit()))
+
+        feed, next_token, _ = Account.changes_since(0, 100)
+        self.assertEqual([record.id for _, record in feed], [second.id, first.id])
+        self.assertEqual(next_token, ChangeLog.latest_token(Account.__tablename__))
+        self.assertEqual(next_token >> ChangeLog.TOKEN_ID_BITS, 2)
+        feed, _, _ = Account.changes_since(feed[0][0].token, 100)
+        self.assertEqual([record.id for _, record in feed], [first.id])
+
+    def test_prune_changes(self):
+        """It should prune changes older than a point in time"""
+        AccountFactory().create()
+        self.assertGreaterEqual(ChangeLog.prune(datetime.utcnow() + timedelta(seconds=1)), 1)
+        self.assertEqual(ChangeLog.latest_token(Account.__tablename__), 0)
+
+    def test_find_by_date_joined(self):
+        """It should Find Accounts that joined within a date range"""
+        for year in (2010, 2012, 2014):
+            AccountFactory(date_joined=date(year, 6, 1)).create()
+        self.assertEqual(len(Account.find_by_date_joined(date(2011, 1, 1))), 2)
+        self.assertEqual(len(Account.find_by_date_joined(end=date(2012, 6, 1))), 1)
+        self.assertEqual(len(Account.find_by_date_joined(date(2011, 1, 1), date(2013, 1, 1))), 1)
+
+    def test_archive(self):
+        """It should move Accounts that joined before a date to the archive in batches"""
+        old = [AccountFactory(date_joined=date(2009, 1, day)) for day in range(1, 6)]
+        recent = AccountFactory(date_joined=date(2020, 1, 1))
+        for account in old + [recent]:
+            account.create()
+        old_ids = [account.id for account in old]
+        first_name = old[0].name
+        token = ChangeLog.latest_token(Account.__tablename__)
+
+        self.assertEqual(Account.archive(date(2015, 1, 1), batch_size=2), 5)
+        self.assertEqual([account.id for account in Account.all()], [recent.id])
+        archived = db.session.execute(account_archive.select().order_by(account_archive.c.id)).all()
+        self.assertEqual([row.id for row in archived], old_ids)
+        self.assertEqual(archived[0].name, first_name)
+        feed, _, _ = Account.changes_since(token, 100)
+        self.assertEqual({change.operation for change, _ in feed}, {ChangeLog.DELETE})
+        self.assertEqual(len(feed), 5)
+
+    def test_count(self):
+        """It should count Accounts exactly or from the maintained counter"""
+        self.assertEqual(Account.count("cached"), (0, "cached"))
+        accounts = [AccountFactory(date_joined=date(2010 + n, 1, 1)) for n in range(4)]
+        for account in accounts:
+            account.create()
+        accounts[0].delete()
+        self.assertEqual(Account.count("cached"), (3, "cached"))
+        self.assertEqual(Account.count("exact"), (3, "exact"))
+        criteria = Account.date_joined_between(date(2012, 1, 1))
+        self.assertEqual(Account.count("cached", criteria), (2, "exact"))
+        # no planner statistics on SQLite, nor on Postgres before the table is analyzed
+        self.assertEqual(Account.count("estimate"), (3, "exact"))
+        if db.engine.dialect.name == "postgresql":
+            db.session.execute(text("ANALYZE account"))
+            self.assertEqual(Account.count("estimate"), (3, "estimate"))
+
+        Account.archive(date(2012, 1, 1), batch_size=10)
+        self.assertEqual(Account.count("cached"), (2, "cached"))
+        db.session.query(Account).delete()
+        db.session.commit()
+        self.assertEqual(Account.count("cached"), (0, "cached"))
+
+    def test_count_ensure_race(self):
+        """It should leave the counter another process created alone"""
+        AccountFactory().create()
+        with patch.object(RowCount, "get", return_value=None):
+            RowCount.ensure(Account)  # loses the race on the primary key
+        self.assertEqual(Account.count("cached"), (1, "cached"))
+
+    def test_bulk_update(self):
+        """It should update matching Accounts in batches and log each change"""
+        accounts = [AccountFactory(address="1 main st") for _ in range(5)]
+        other = AccountFactory(address="2 Elm Road")
+        for account in accounts + [other]:
+            account.create()
+        ids = [account.id for account in accounts]
+        token = ChangeLog.latest_token(Account.__tablename__)
+        generation = Account.generation
+
+        criteria = Account.matching(address="1 main st")
+        self.assertEqual(Account.bulk_update(criteria, Account.bulk_values({"address": "1 Main Street"}), 2), 5)
+        self.assertEqual(Account.generation, generation + 3)
+        db.session.expire_all()
+        self.assertEqual({account.address for account in Account.find_many(ids).values()}, {"1 Main Street"})
+        self.assertEqual(Account.find(other.id).address, "2 Elm Road")
+        feed, _, _ = Account.changes_since(token, 100)
+        self.assertEqual(sorted(change.resource_id for change, _ in feed), ids)
+        self.assertRaises(DataValidationError, Account.bulk_values, {"id": 1})
+        self.assertRaises(DataValidationError, Account.bulk_values, {"name": None})
+        self.assertRaises(DataValidationError, Account.bulk_values, {})
+
+    def test_bulk_delete(self):
+        """It should delete matching Accounts in batches and keep the count"""
+        accounts = [AccountFactory(date_joined=date(2010 + n, 1, 1)) for n in range(5)]
+        for account in accounts:
+            account.create()
+        ids = [account.id for account in accounts]
+        token = ChangeLog.latest_token(Account.__tablename__)
+
+        criteria = Account.matching(ids=ids[:4], joined_after=date(2011, 1, 1))
+        self.assertEqual(Account.bulk_delete(criteria, 2), 3)
+        self.assertEqual([account.id for account in Account.all()], [ids[0], ids[4]])
+        self.assertEqual(Account.count("cached"), (2, "cached"))
+        feed, _, _ = Account.changes_since(token, 100)
+        self.assertEqual([(change.operation, change.resource_id) for change, _ in feed],
+                         [(ChangeLog.DELETE, account_id) for account_id in ids[1:4]])
+
+    def test_duplicate_email(self):
+        """It should not give an email that is taken to another Account"""
+        account = AccountFactory(email="Taken@Example.com")
+        account.create()
+        self.assertRaises(DuplicateEmailError, AccountFactory(email="taken@example.com").create)
+        self.assertRaises(DuplicateEmailError, Account.create_many, [AccountFactory(email="TAKEN@example.com")])
+        self.assertRaises(DuplicateEmailError, Account.create_many,
+                          [AccountFactory(email="new@example.com"), AccountFactory(email="New@example.com")])
+
+        other = AccountFactory()
+        other.create()
+        other = Account.find(other.id)
+        other.email = "taken@EXAMPLE.com"
+        self.assertRaises(DuplicateEmailError, other.update)
+        self.assertEqual(other.email, Account.find(other.id).email)
+        account.email = "taken@example.com"  # its own email in another case
+        account.update()
+
+        criteria = Account.matching(ids=[account.id, other.id])
+        self.assertRaises(DuplicateEmailError, Account.bulk_update, criteria, {"email": "both@example.com"}, 10)
+        criteria = Account.matching(ids=[other.id])
+        self.assertRaises(DuplicateEmailError, Account.bulk_update, criteria, {"email": "TAKEN@example.com"}, 10)
+        self.assertEqual(Account.bulk_update(criteria, {"email": "mine@example.com"}, 10), 1)
+        self.assertEqual(Account.count("exact"), (2, "exact"))
+
+    def test_email_filter(self):
+        """It should only look up the emails the filter may have seen"""
+        AccountFactory(email="seen@example.com").create()
+        checks = dict(Account.email_checks)
+        AccountFactory(email="unseen@example.com").create()
+        self.assertRaises(DuplicateEmailError, AccountFactory(email="seen@example.com").create)
+        self.assertEqual(Account.email_checks["checked"], checks.get("checked", 0) + 2)
+        self.assertLessEqual(Account.email_checks["looked_up"], checks.get("looked_up", 0) + 2)
+        self.assertEqual(Account.email_checks["rejected"], checks.get("rejected", 0) + 1)
+        stats = Account.email_filter_stats()
+        self.assertGreaterEqual(stats["keys"], 2)
+        self.assertGreaterEqual(stats["capacity"], app.config["EMAIL_FILTER_MIN_CAPACITY"])
+
+    def test_email_index(self):
+        """It should reject a taken email the filter has not seen"""
+        AccountFactory(email="stale@example.com").create()
+        email_filter = Account.email_filter
+        Account.email_filter = BloomFilter(10)
+        try:
+            self.assertRaises(DuplicateEmailError, AccountFactory(email="Stale@example.com").create)
+            self.assertEqual(Account.count("exact"), (1, "exact"))
+        finally:
+            Account.email_filter = email_filter
+        Account.build_email_filter()
+        self.assertIn("stale@example.com", Account.email_filter)
+
+    def test_email_filter_rebuilt_in_background(self):
+        """It should build a larger email filter off the request thread"""
+        AccountFactory(email="old@example.com").create()
+        email_filter = Account.email_filter
+        fill = Account._fill_email_filter
+        filling, release = threading.Event(), threading.Event()
+
+        def slow_fill():
+            filling.set()
+            release.wait(5)
+            return fill()
+
+        Account.email_filter = BloomFilter(1)
+        try:
+            with patch.object(Account, "_fill_email_filter", side_effect=slow_fill):
+                Account.remember_emails(["first@example.com", "second@example.com"])
+                self.assertTrue(filling.wait(5))
+                Account.remember_emails(["new@example.com"])  # returns while the filter is built
+                self.assertIn("new@example.com", Account.email_filter)
+                release.set()
+                Account._email_builder.join(5)
+            self.assertIn("old@example.com", Account.email_filter)
+            self.assertIn("new@example.com", Account.email_filter)
+            self.assertFalse(Account.email_filter.full())
+            self.assertIsNone(Account._email_pending)
+        finally:
+            release.set()
+            Account.email_filter = email_filter
+
+    def test_signup_rollup(self):
+        """It should keep the signups per day up to date on every write"""
+        Account.rebuild_rollup()  # setUp deletes at query level, which the rollup does not follow
+        accounts = [AccountFactory(date_joined=date(2020, 1, day)) for day in (1, 1, 2)]
+        accounts[0].create()
+        Account.create_many(accounts[1:])
+        late = AccountFactory(date_joined=date(2020, 3, 5))
+        late.create()
+        self.assertEqual(Account.signups("day"), [("2020-01-01", 2), ("2020-01-02", 1), ("2020-03-05", 1)])
+        self.assertEqual(Account.signups("month"), [("2020-01", 3), ("2020-03", 1)])
+        self.assertEqual(Account.signups("year", date(2020, 1, 2), date(2020, 3, 5)), [("2020", 1)])
+
+        accounts[0].date_joined = date(2020, 3, 1)
+        accounts[0].update()
+        late.delete()
+        Account.bulk_delete(Account.matching(ids=[accounts[2].id]), 10)
+        self.assertEqual(Account.signups("month"), [("2020-01", 1), ("2020-03", 1)])
+        Account.archive(date(2020, 2, 1), 10)
+        self.assertEqual(Account.signups("month"), [("2020-01", 1), ("2020-03", 1)])
+        self.assertEqual(Account.rebuild_rollup(), 2)
+        self.assertEqual(Account.signups("month"), [("2020-01", 1), ("2020-03", 1)])
+        self.assertEqual(Account.rebuild_rollup(only_empty=True), 0)  # left to the worker that got there first
+
+    def test_search(self):
+        """It should search Accounts by name and address and follow later writes"""
+        smith = AccountFactory(name="John Smith", address="12 Main Street")
+        smyth = AccountFactory(name="Jane Smyth", address="4 Elm Road")
+        for account in (smith, smyth):
+            account.create()
+        results = Account.search("smith", 10, 0.2)
+        self.assertEqual([account.id for account, _ in results], [smith.id, smyth.id])
+        self.assertGreater(results[0][1], 1)
+
+        smyth.address = "1 Mainway"
+        smyth.update()
+        self.assertEqual(len(Account.search("main", 10, 0.3)), 2)
+        smith.delete()
+        self.assertEqual([account.id for account, _ in Account.search("main", 10, 0.3)], [smyth.id])
+
     def test_serialize_an_account(self):
         """It should Serialize an account"""
         account = AccountFactory()
@@ -171,6 +458,12 @@ class TestAccount(unittest.TestCase):
         account = Account()
         self.assertRaises(DataValidationError, account.deserialize, {})
 
+    def test_deserialize_with_bad_email(self):
+        """It should not Deserialize an account whose email is not a string"""
+        data = AccountFactory().serialize()
+        data["email"] = 5
+        self.assertRaises(DataValidationError, Account().deserialize, data)
+
     def test_deserialize_with_type_error(self):
         """It should not Deserialize an account with a TypeError"""
         account = Account()
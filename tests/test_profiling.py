@@ -0,0 +1,88 @@
+"""
+Profiling Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import threading
+import time
+from unittest import TestCase
+from service.common.profiling import CpuProfiler, HeapProfiler
+
+
+def busy_worker(stop):
+    """Keeps a thread inside a known function until stop is set"""
+    while not stop.is_set():
+        time.sleep(0.001)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestCpuProfiler(TestCase):
+    """CPU Profiler Tests"""
+
+    def test_collapsed_stacks(self):
+        """It should count the stacks of other threads, root first"""
+        stop = threading.Event()
+        worker = threading.Thread(target=busy_worker, args=(stop,), name="busy worker")
+        worker.start()
+        profiler = CpuProfiler()
+        try:
+            self.assertTrue(profiler.start(0.2, 0.005))
+            self.assertFalse(profiler.start(0.2, 0.005))
+            profiler.stop()
+        finally:
+            stop.set()
+            worker.join()
+        lines = profiler.collapsed().splitlines()
+        busy = [line for line in lines if line.startswith("busy_worker;")]
+        self.assertTrue(busy, lines)
+        stack, count = busy[0].rsplit(" ", 1)
+        self.assertTrue(stack.endswith("tests.test_profiling:busy_worker"))
+        self.assertGreater(int(count), 0)
+        self.assertFalse(any("cpu-profiler" in line for line in lines))
+        stats = profiler.stats()
+        self.assertFalse(stats["running"])
+        self.assertEqual(stats["profiles"], 1)
+        self.assertIsNotNone(stats["finished_at"])
+
+    def test_idle_until_started(self):
+        """It should not run a thread before a profile is started"""
+        profiler = CpuProfiler()
+        self.assertFalse(profiler.running())
+        self.assertEqual(profiler.collapsed(), "")
+        profiler.stop()
+
+
+class TestHeapProfiler(TestCase):
+    """Heap Profiler Tests"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.profiler = HeapProfiler()
+
+    def tearDown(self):
+        """Runs after each test"""
+        self.profiler.stop()
+
+    def test_top_and_diff(self):
+        """It should report the largest allocations and the growth since start"""
+        self.assertRaises(RuntimeError, self.profiler.top, 10)
+        self.assertEqual(self.profiler.stats(), {"tracing": False})
+        self.assertTrue(self.profiler.start(5))
+        self.assertFalse(self.profiler.start(5))
+        hoard = [bytearray(1024) for _ in range(200)]
+        top = self.profiler.top(3)
+        self.assertLessEqual(len(top["stats"]), 3)
+        self.assertIn(__file__, top["stats"][0]["location"])
+        diff = self.profiler.top(3, "filename", diff=True)
+        self.assertEqual(diff["stats"][0]["location"], __file__)
+        self.assertGreaterEqual(diff["stats"][0]["size_diff"], 200 * 1024)
+        traceback = self.profiler.top(1, "traceback")
+        self.assertIsInstance(traceback["stats"][0]["traceback"], list)
+        self.assertTrue(self.profiler.stats()["tracing"])
+        del hoard
+        self.profiler.stop()
+        self.assertFalse(self.profiler.tracing())
@@ -0,0 +1,153 @@
+"""
+Rate Limiting and Load Shedding Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import logging
+from unittest import TestCase
+from unittest.mock import MagicMock
+from service import talisman
+from service.common import status  # HTTP Status Codes
+from service.common.rate_limit import (
+    LoadShedder, MemoryBackend, RateLimiter, client_id, limiter, parse_routes, shedder
+)
+from service.routes import app
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestRateLimiter(TestCase):
+    """Token Bucket Tests"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.now = 0.0
+        self.limiter = RateLimiter(rate=1.0, burst=2, routes={"slow": (0.5, 1)})
+        self.limiter.clock = lambda: self.now
+
+    def test_burst_then_refill(self):
+        """It should allow a burst and then one request per refilled token"""
+        self.assertEqual(self.limiter.check("a", "index"), 0)
+        self.assertEqual(self.limiter.check("a", "index"), 0)
+        self.assertAlmostEqual(self.limiter.check("a", "index"), 1.0)
+        self.now = 1.0
+        self.assertEqual(self.limiter.check("a", "index"), 0)
+        self.assertEqual(self.limiter.stats()["limited"], 1)
+
+    def test_buckets_are_per_client_and_route(self):
+        """It should keep a separate bucket per client and route"""
+        self.assertEqual(self.limiter.check("a", "slow"), 0)
+        self.assertAlmostEqual(self.limiter.check("a", "slow"), 2.0)
+        self.assertEqual(self.limiter.check("b", "slow"), 0)
+        self.assertEqual(self.limiter.check("a", "index"), 0)
+
+    def test_prune_idle_buckets(self):
+        """It should drop idle buckets once it tracks too many"""
+        backend = MemoryBackend(max_keys=2)
+        for key in range(3):
+            backend.take(key, 1.0, 1, 0.0)
+        backend.take("late", 1.0, 1, 100.0)
+        self.assertEqual(len(backend._buckets), 1)  # pylint: disable=protected-access
+
+    def test_parse_routes(self):
+        """It should parse per route overrides"""
+        self.assertEqual(parse_routes("a=1:2, b=0.5:1"), {"a": (1.0, 2), "b": (0.5, 1)})
+        self.assertEqual(parse_routes(""), {})
+
+
+class TestLoadShedder(TestCase):
+    """Load Shedding Tests"""
+
+    def test_max_in_flight(self):
+        """It should shed requests above the in flight limit"""
+        shed = LoadShedder(max_in_flight=1)
+        self.assertTrue(shed.enter())
+        self.assertFalse(shed.enter())
+        shed.exit()
+        self.assertTrue(shed.enter())
+        self.assertEqual(shed.stats()["shed"], 1)
+
+    def test_pool_exhausted(self):
+        """It should shed requests when the connection pool has no capacity left"""
+        pool = MagicMock(_max_overflow=2)
+        pool.size.return_value = 5
+        pool.checkedout.return_value = 7
+        self.assertFalse(LoadShedder(pool=pool).enter())
+        pool.checkedout.return_value = 6
+        self.assertTrue(LoadShedder(pool=pool).enter())
+
+
+class TestThrottledRoutes(TestCase):
+    """Throttling Request Hook Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        talisman.force_https = False
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        limiter.backend.clear()
+
+    def tearDown(self):
+        """Runs after each test"""
+        limiter.enabled = False
+        limiter.routes = {}
+        shedder.max_in_flight = 0
+
+    def test_too_many_requests(self):
+        """It should answer 429 with Retry-After once a client exhausts its bucket"""
+        limiter.enabled = True
+        limiter.routes = {"index": (0.5, 2)}
+        for _ in range(2):
+            self.assertEqual(self.client.get("/").status_code, status.HTTP_200_OK)
+        response = self.client.get("/")
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response.headers["Retry-After"], "2")
+        self.assertEqual(response.get_json()["error"], "Too Many Requests")
+        self.assertEqual(self.client.get("/health").status_code, status.HTTP_200_OK)
+
+    def test_service_unavailable(self):
+        """It should answer 503 with Retry-After when the worker is saturated"""
+        shedder.max_in_flight = 1
+        shedder.in_flight += 1
+        try:
+            response = self.client.get("/")
+        finally:
+            shedder.in_flight -= 1
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.headers["Retry-After"], "1")
+        self.assertEqual(self.client.get("/").status_code, status.HTTP_200_OK)
+        self.assertEqual(shedder.in_flight, 0)
+
+    def test_client_behind_trusted_proxies(self):
+        """It should key clients on the address the outermost trusted proxy saw, not on spoofable entries"""
+        headers = {"X-Forwarded-For": "6.6.6.6, 203.0.113.7, 10.0.0.2"}
+        environ = {"REMOTE_ADDR": "10.0.0.3"}
+        with app.test_request_context("/", headers=headers, environ_base=environ):
+            self.assertEqual(client_id(), "10.0.0.3")  # no proxy trusted
+            for hops, expected in ((1, "10.0.0.2"), (2, "203.0.113.7"), (4, "10.0.0.3")):
+                app.config["RATE_LIMIT_TRUSTED_PROXIES"] = hops
+                self.assertEqual(client_id(), expected)
+        app.config["RATE_LIMIT_TRUSTED_PROXIES"] = 0
+
+    def test_spoofed_forwarded_for_shares_a_bucket(self):
+        """It should limit a client that rotates the entries it adds to X-Forwarded-For"""
+        limiter.enabled = True
+        limiter.routes = {"index": (0.5, 2)}
+        app.config["RATE_LIMIT_TRUSTED_PROXIES"] = 1
+        try:
+            codes = [
+                self.client.get("/", headers={"X-Forwarded-For": f"198.51.100.{n}, 203.0.113.7"}).status_code
+                for n in range(3)
+            ]
+        finally:
+            app.config["RATE_LIMIT_TRUSTED_PROXIES"] = 0
+        self.assertEqual(codes[-1], status.HTTP_429_TOO_MANY_REQUESTS)
@@ -0,0 +1,82 @@
+"""
+Single Flight Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import threading
+import time
+from unittest import TestCase
+from service.common.single_flight import SingleFlight
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSingleFlight(TestCase):
+    """Single Flight Tests"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.flight = SingleFlight()
+        self.release = threading.Event()
+        self.calls = 0
+        self.result = None
+
+    def slow_query(self):
+        """Stands in for a database query that blocks until released"""
+        self.calls += 1
+        self.release.wait(5)
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+    def run_concurrently(self, followers):
+        """Starts a leader and followers on the same key and collects their outcomes"""
+        outcomes = []
+
+        def call():
+            try:
+                outcomes.append(self.flight.do("key", self.slow_query))
+            except Exception as error:  # pylint: disable=broad-except
+                outcomes.append(error)
+
+        threads = [threading.Thread(target=call) for _ in range(followers + 1)]
+        threads[0].start()
+        self.wait_for(lambda: self.calls == 1)
+        for thread in threads[1:]:
+            thread.start()
+        self.wait_for(lambda: self.flight.stats()["coalesced"] == followers)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        return outcomes
+
+    @staticmethod
+    def wait_for(condition):
+        """Polls until condition() holds"""
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+    def test_concurrent_calls_share_one_execution(self):
+        """It should run a hot key once for all concurrent callers"""
+        self.result = {"id": 1}
+        outcomes = self.run_concurrently(followers=5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(outcomes, [{"id": 1}] * 6)
+        self.assertEqual(self.flight.stats(), {"executions": 1, "coalesced": 5, "in_flight": 0})
+
+    def test_errors_reach_every_caller(self):
+        """It should raise the leader's error in every waiting caller"""
+        self.result = RuntimeError("database is down")
+        outcomes = self.run_concurrently(followers=2)
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(all(outcome is self.result for outcome in outcomes))
+
+    def test_sequential_calls_are_not_coalesced(self):
+        """It should run the function again once the previous call has finished"""
+        self.assertEqual(self.flight.do("key", lambda: 1), 1)
+        self.assertEqual(self.flight.do("key", lambda: 2), 2)
+        self.assertEqual(self.flight.stats()["executions"], 2)
@@ -0,0 +1,60 @@
+"""
+Statement Cache Statistics Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+from unittest import TestCase
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine, select, text
+from service.common.statement_stats import StatementStats
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestStatementStats(TestCase):
+    """Statement Cache Statistics Tests"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.engine = create_engine("sqlite://", query_cache_size=10)
+        self.table = Table("item", MetaData(), Column("id", Integer, primary_key=True))
+        self.table.create(self.engine)
+        self.stats = StatementStats()
+        self.stats.attach(self.engine)
+
+    def tearDown(self):
+        """Runs after each test"""
+        self.engine.dispose()
+
+    def test_hits_and_misses(self):
+        """It should count a compile on first use and cache hits after"""
+        with self.engine.connect() as connection:
+            for item_id in range(3):
+                connection.execute(select(self.table).where(self.table.c.id == item_id)).all()
+        stats = self.stats.stats()
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["hit_ratio"], 0.6667)
+        self.assertEqual(stats["entries"], 1)
+        self.assertEqual(stats["capacity"], 10)
+
+    def test_uncached_statements(self):
+        """It should count driver level SQL apart from cache lookups"""
+        with self.engine.connect() as connection:
+            connection.exec_driver_sql("SELECT 1").all()
+        stats = self.stats.stats()
+        self.assertEqual(stats["hits"] + stats["misses"], 0)
+        self.assertEqual(stats["hit_ratio"], 0.0)
+        self.stats.reset()
+        self.assertEqual(sum(stats[key] for key in ("disabled", "uncacheable", "unsupported")), 1)
+
+    def test_attach_again(self):
+        """It should only count the engine attached last"""
+        other = create_engine("sqlite://")
+        self.stats.attach(other)
+        with self.engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        self.assertEqual(self.stats.stats()["misses"], 0)
+        other.dispose()
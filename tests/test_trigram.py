@@ -0,0 +1,64 @@
+"""
+Trigram Index Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+from unittest import TestCase
+from service.common.trigram import TrigramIndex, inner_trigrams, similarity, trigrams
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestTrigramIndex(TestCase):
+    """Trigram Index Tests"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.index = TrigramIndex()
+        self.index.add(1, "John Smith", "12 Main Street")
+        self.index.add(2, "Jane Smyth", "4 Elm Road")
+        self.index.add(3, "Bob Jones", "99 Mainway Avenue")
+
+    def test_trigrams(self):
+        """It should pad words like pg_trgm"""
+        self.assertEqual(trigrams("Cat"), {"  c", " ca", "cat", "at "})
+        self.assertEqual(trigrams("a-b"), {"  a", " a ", "  b", " b "})
+        self.assertEqual(inner_trigrams("main st"), {"mai", "ain"})
+        self.assertEqual(similarity(trigrams("word"), trigrams("word")), 1.0)
+        self.assertEqual(similarity(set(), trigrams("word")), 0.0)
+
+    def test_substring_matches_rank_first(self):
+        """It should rank substring matches above fuzzy ones"""
+        results = self.index.search("main", 10, 0.3)
+        self.assertEqual([doc_id for doc_id, _ in results], [1, 3])
+        self.assertTrue(all(score > 1 for _, score in results))
+        self.assertEqual(self.index.search("ain st", 10, 0.9)[0][0], 1)
+
+    def test_fuzzy_match(self):
+        """It should find misspelled names above the threshold"""
+        results = self.index.search("smith", 10, 0.2)
+        self.assertEqual([doc_id for doc_id, _ in results], [1, 2])
+        self.assertEqual(self.index.search("smith", 10, 0.9)[0][0], 1)
+        self.assertEqual(self.index.search("xyz", 10, 0.3), [])
+
+    def test_limit(self):
+        """It should return at most limit matches"""
+        self.assertEqual(len(self.index.search("m", 1, 0.1)), 1)
+
+    def test_short_words_are_not_scanned(self):
+        """It should only fuzzy match a query without a word of 3 letters"""
+        self.assertEqual(self.index.search("12 m", 10, 0.9), [])
+
+    def test_update_and_remove(self):
+        """It should reindex replaced documents and forget removed ones"""
+        self.index.add(1, "Alice Walker", "1 Oak Lane")
+        self.assertEqual([doc_id for doc_id, _ in self.index.search("main", 10, 0.3)], [3])
+        self.index.remove(3)
+        self.index.remove(3)
+        self.assertEqual(self.index.search("main", 10, 0.3), [])
+        self.assertEqual(len(self.index), 2)
+        self.index.clear()
+        self.assertEqual(len(self.index), 0)